@@ -5,7 +5,7 @@
 
 from g2p.g2p import cleaners
 from tokenizers import Tokenizer
-from g2p.g2p.text_tokenizers import TextTokenizer
+from g2p.g2p.text_tokenizers import LazyTextTokenizers
 from thirdparty.LangSegment import LangSegment
 import json
 import re
@@ -21,8 +21,7 @@ class PhonemeBpeTokenizer:
             "ko": "ko",
             "de": "de",
         }
-        self.text_tokenizers = {}
-        self.int_text_tokenizers()
+        self.text_tokenizers = LazyTextTokenizers(self.lang2backend)
 
         with open(vacab_path, "r", encoding='utf-8') as f:
             json_data = f.read()
@@ -31,8 +30,9 @@ class PhonemeBpeTokenizer:
         LangSegment.setfilters(["en", "zh", "ko", "fr", "de"])
 
     def int_text_tokenizers(self):
-        for key, value in self.lang2backend.items():
-            self.text_tokenizers[key] = TextTokenizer(language=value)
+        # backends are otherwise created on first use of a language
+        for key in self.lang2backend:
+            self.text_tokenizers[key]
 
     def tokenize(self, text, sentence, language):
 
@@ -8,12 +8,9 @@ import numpy as np
 import torch
 from torch.utils.data import DataLoader
 import json
-from transformers import BertTokenizer
 from torch.utils.data import Dataset
-from transformers.models.bert.modeling_bert import *
 import torch
 import torch.nn.functional as F
-from onnxruntime import InferenceSession, GraphOptimizationLevel, SessionOptions
 
 
 class PolyDataset(Dataset):
@@ -106,6 +103,10 @@ class PolyDataset(Dataset):
 
 class BertPolyPredict:
     def __init__(self, bert_model, jsonr_file, json_file):
+        # heavy imports, only paid when a polyphonic character is met
+        from transformers import BertTokenizer
+        from onnxruntime import InferenceSession, GraphOptimizationLevel, SessionOptions
+
         self.tokenizer = BertTokenizer.from_pretrained(bert_model, do_lower_case=True)
         with open(jsonr_file, "r", encoding="utf8") as fp:
             self.pron_dict = json.load(fp)
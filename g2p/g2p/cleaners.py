@@ -14,7 +14,8 @@ from g2p.g2p.german import german_to_ipa
 def cjekfd_cleaners(text, sentence, language, text_tokenizers):
 
     if language == "zh":
-        return chinese_to_ipa(text, sentence, text_tokenizers["zh"])
+        # mandarin goes through pinyin, the cmn espeak backend is never used
+        return chinese_to_ipa(text, sentence, None)
     elif language == "en":
         return english_to_ipa(text, text_tokenizers["en"])
     elif language == "fr":
@@ -4,6 +4,7 @@
 # LICENSE file in the root directory of this source tree.
 
 import re
+import threading
 import jieba
 import cn2an
 from pypinyin import lazy_pinyin, BOPOMOFO
@@ -64,9 +65,19 @@ if not os.path.exists(jsonr_file_path):
     )
     exit()
 
-g2pw_poly_predict = BertPolyPredict(
-    g2pw_poly_model_path, jsonr_file_path, json_file_path
-)
+_g2pw_poly_predict = None
+_g2pw_poly_predict_lock = threading.Lock()
+
+
+def get_g2pw_poly_predict():
+    # the polyphone bert session is loaded on first use
+    global _g2pw_poly_predict
+    with _g2pw_poly_predict_lock:
+        if _g2pw_poly_predict is None:
+            _g2pw_poly_predict = BertPolyPredict(
+                g2pw_poly_model_path, jsonr_file_path, json_file_path
+            )
+    return _g2pw_poly_predict
 
 
 """
@@ -505,7 +516,7 @@ def chinese_to_bopomofo(text_short, sentence):
             for i in range(len(word)):
                 c = word[i]
                 if c in poly_dict:
-                    poly_pinyin = g2pw_poly_predict.predict_process(
+                    poly_pinyin = get_g2pw_poly_predict().predict_process(
                         [text_short, char_index + i]
                     )[0]
                     py = poly_pinyin[2:-1]
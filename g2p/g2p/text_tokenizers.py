@@ -5,6 +5,7 @@
 
 import re
 import os
+import threading
 from typing import List, Pattern, Union
 from phonemizer.utils import list2str, str2list
 from phonemizer.backend import EspeakBackend
@@ -82,3 +83,18 @@ class TextTokenizer:
                 phonemized[i] = re.sub(r"\|+", "|", phonemized[i])
                 phonemized[i] = phonemized[i].rstrip("|")
         return phonemized
+
+
+class LazyTextTokenizers(dict):
+    """language -> TextTokenizer, the espeak backend of a language is created on first use."""
+
+    def __init__(self, lang2backend):
+        super().__init__()
+        self.lang2backend = lang2backend
+        self._lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self._lock:
+            if key not in self:
+                self[key] = TextTokenizer(language=self.lang2backend[key])
+            return dict.__getitem__(self, key)
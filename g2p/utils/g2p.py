@@ -10,49 +10,40 @@ from typing import List, Union
 import os
 import json
 import sys
+import threading
 
 # separator=Separator(phone=' ', word=' _ ', syllable='|'),
 separator = Separator(word=" _ ", syllable="|", phone=" ")
 
-phonemizer_zh = EspeakBackend(
-    "cmn", preserve_punctuation=False, with_stress=False, language_switch="remove-flags"
-)
-# phonemizer_zh.separator = separator
-
-phonemizer_en = EspeakBackend(
-    "en-us",
-    preserve_punctuation=False,
-    with_stress=False,
-    language_switch="remove-flags",
-)
-# phonemizer_en.separator = separator
-
-phonemizer_ko = EspeakBackend(
-    "ko", preserve_punctuation=False, with_stress=False, language_switch="remove-flags"
-)
-# phonemizer_ko.separator = separator
-
-phonemizer_fr = EspeakBackend(
-    "fr-fr",
-    preserve_punctuation=False,
-    with_stress=False,
-    language_switch="remove-flags",
-)
-# phonemizer_fr.separator = separator
-
-phonemizer_de = EspeakBackend(
-    "de", preserve_punctuation=False, with_stress=False, language_switch="remove-flags"
-)
-# phonemizer_de.separator = separator
-
-
-lang2backend = {
-    "zh": phonemizer_zh,
-    "en": phonemizer_en,
-    "fr": phonemizer_fr,
-    "ko": phonemizer_ko,
-    "de": phonemizer_de,
-}
+
+class LazyEspeakBackends(dict):
+    """language -> EspeakBackend, created on first use of a language."""
+
+    languages = {
+        "zh": "cmn",
+        "en": "en-us",
+        "fr": "fr-fr",
+        "ko": "ko",
+        "de": "de",
+    }
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+
+    def __missing__(self, key):
+        with self._lock:
+            if key not in self:
+                self[key] = EspeakBackend(
+                    self.languages[key],
+                    preserve_punctuation=False,
+                    with_stress=False,
+                    language_switch="remove-flags",
+                )
+            return dict.__getitem__(self, key)
+
+
+lang2backend = LazyEspeakBackends()
 
 with open("./g2p/utils/mls_en.json", "r", encoding='utf-8') as f:
     json_data = f.read()
@@ -0,0 +1,73 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Calibrates int8 quantization of the dit on representative prompts.
+
+    The float model samples every job of a jsonl file (same fields as infer/pool.py) for a few
+    steps while the inputs of the quantizable linears are recorded. Linears whose output changes
+    by more than --threshold (relative l2) when quantized are listed under "skip" and kept in float.
+
+    python3 infer/calibrate_int8.py --jobs jobs.jsonl --output ./pretrained/int8_calibration.json
+    python3 infer/infer.py --quantize int8-dynamic --quant-config ./pretrained/int8_calibration.json ...
+"""
+
+import argparse
+import json
+import os
+
+import torch
+
+from infer_utils import get_negative_style_prompt, prepare_model, prepare_request
+from model.quantization import QUANT_MODES, calibrate_dit
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=str, required=True, help="jsonl file, one calibration request per line")
+    parser.add_argument("--output", type=str, required=True, help="calibration json written here")
+    parser.add_argument("--mode", type=str, default="int8-dynamic", choices=QUANT_MODES)
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=2048,
+        choices=[2048, 6144],
+        help="2048 for 95 s songs, 6144 for 96 to 285 s songs",
+    )
+    parser.add_argument("--steps", type=int, default=8, help="sampling steps per calibration request")
+    parser.add_argument("--threshold", type=float, default=0.05, help="relative error above which a linear stays float")
+    parser.add_argument("--ckpt-path", type=str, default=None, help="cfm checkpoint, see infer.py")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() and args.mode == "int8-weight" else "cpu"
+    cfm, tokenizer, muq, vae = prepare_model(args.max_frames, device, ckpt_path=args.ckpt_path, dtype=torch.float32)
+    negative_style_prompt = get_negative_style_prompt(device, dtype=torch.float32)
+
+    with open(args.jobs, encoding="utf-8") as f:
+        jobs = [json.loads(line) for line in f if line.strip()]
+    requests = [
+        prepare_request(job, args.max_frames, tokenizer, muq, vae, negative_style_prompt, device, dtype=torch.float32)
+        for job in jobs
+    ]
+
+    def run():
+        for request in requests:
+            cfm.sample_batch([request], steps=args.steps)
+
+    errors = calibrate_dit(cfm.transformer, run, mode=args.mode)
+    skip = sorted(name for name, error in errors.items() if error > args.threshold)
+    print(f"{len(errors) - len(skip)} of {len(errors)} linears quantized, kept in float: {skip}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"mode": args.mode, "threshold": args.threshold, "skip": skip, "errors": errors}, f, indent=2)
@@ -0,0 +1,122 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Numerical equivalence of the native LlamaBlock and transformers' LlamaDecoderLayer.
+
+    Builds the transformers layer the dit used before (default LlamaConfig) with transformers' own
+    sdpa attention, non causal like the dit, loads its weights into a LlamaBlock through the state dict adapter and compares rotary tables,
+    block outputs with and without padding mask, the saved state dict and the time per call.
+    Exits with status 1 when a difference exceeds --atol.
+
+    python3 infer/check_dit_block.py --seq-len 2048 --dtype fp32
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+from sys import path
+path.append(os.getcwd())
+
+from model.modules import LlamaBlock, RotaryEmbedding, _prepare_decoder_attention_mask
+
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def timed(fn, repeats):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    s_t = time.time()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - s_t) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dim", type=int, default=2048)
+    parser.add_argument("--ff-mult", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=512)
+    parser.add_argument("--batch-size", type=int, default=2)
+    parser.add_argument("--dtype", type=str, default="fp32", choices=list(DTYPES))
+    parser.add_argument("--atol", type=float, default=None, help="default 1e-4 for fp32, 2e-2 otherwise")
+    parser.add_argument("--repeats", type=int, default=5, help="timed calls per block")
+    args = parser.parse_args()
+
+    from transformers.models.llama import LlamaConfig
+    from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaRotaryEmbedding
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = DTYPES[args.dtype]
+    atol = args.atol or (1e-4 if dtype == torch.float32 else 2e-2)
+    torch.manual_seed(0)
+
+    config = LlamaConfig(hidden_size=args.dim, intermediate_size=args.dim * args.ff_mult, hidden_act="silu")
+    config._attn_implementation = "sdpa"
+    reference = LlamaDecoderLayer(config, layer_idx=0).to(device, dtype).eval()
+    for p in reference.parameters():
+        torch.nn.init.normal_(p, std=0.02)
+    reference_rotary = LlamaRotaryEmbedding(config=config).to(device)
+
+    block = LlamaBlock(args.dim, args.dim * args.ff_mult).to(device, dtype).eval()
+    block.load_state_dict(reference.state_dict())
+    rotary = RotaryEmbedding(args.dim // config.num_attention_heads, max_pos=args.seq_len).to(device)
+
+    x = torch.randn(args.batch_size, args.seq_len, args.dim, device=device, dtype=dtype)
+    pos_ids = torch.arange(args.seq_len, device=device).unsqueeze(0)
+    lens = torch.tensor([args.seq_len] + [args.seq_len * 3 // 4] * (args.batch_size - 1), device=device)
+    mask = torch.arange(args.seq_len, device=device)[None] < lens[:, None]
+    attention_mask = _prepare_decoder_attention_mask(mask, mask.shape, x)
+
+    failed = False
+
+    def report(name, diff):
+        global failed
+        failed |= diff > atol
+        print(f"{name:<24} max abs diff {diff:.3e}{'  FAILED' if diff > atol else ''}")
+
+    with torch.inference_mode():
+        reference_embed = reference_rotary(x, pos_ids)
+        embed = rotary(x, pos_ids)
+        report("rotary cos / sin", max((a - b).abs().max().item() for a, b in zip(reference_embed, embed)))
+
+        def run_reference(mask=None):
+            # sdpa defaults to causal attention without a mask
+            out = reference(x, attention_mask=mask, position_embeddings=reference_embed, is_causal=False)
+            return out[0] if isinstance(out, tuple) else out
+
+        report("block", (run_reference() - block(x, embed)).abs().max().item())
+        padded = (run_reference(attention_mask) - block(x, embed, attention_mask)) * mask[..., None]
+        report("block with padding mask", padded.abs().max().item())
+
+        state_dict = block.state_dict()
+        reference_state_dict = reference.state_dict()
+        if state_dict.keys() != reference_state_dict.keys():
+            failed = True
+            print(f"state dict keys differ: {sorted(state_dict.keys() ^ reference_state_dict.keys())}")
+        else:
+            report("saved state dict", max((state_dict[k] - v).abs().max().item() for k, v in reference_state_dict.items()))
+
+        reference_time = timed(lambda: run_reference(), args.repeats)
+        block_time = timed(lambda: block(x, embed), args.repeats)
+    print(f"time per call: LlamaDecoderLayer {reference_time * 1000:.2f} ms, LlamaBlock {block_time * 1000:.2f} ms")
+
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,91 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Parity and speed of the vae backends against the torchscript module.
+
+    Decodes a random latent of --frames frames with every backend (chunked as in inference unless
+    --unchunked), encodes the decoded audio again and compares both with the torchscript results,
+    then times the decoding. Exits with status 1 when a difference exceeds --atol.
+
+    python3 infer/check_vae_backend.py --frames 6144 --backends frozen onnx
+"""
+
+import argparse
+import sys
+import time
+
+import torch
+
+from infer_utils import decode_audio, encode_audio, load_vae
+from vae_backend import VAE_BACKENDS, load_vae_backend
+
+
+def timed(fn, repeats):
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    s_t = time.time()
+    for _ in range(repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.time() - s_t) / repeats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backends", type=str, nargs="+", default=["frozen", "onnx"], choices=VAE_BACKENDS[1:])
+    parser.add_argument("--frames", type=int, default=2048, help="latent frames, 2048 is a 95 s song")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--unchunked", action="store_true", help="decode the whole latent in one call")
+    parser.add_argument("--device", type=str, default=None, help="default cuda if available")
+    parser.add_argument("--onnx-dir", type=str, default="./pretrained/vae_onnx", help="exported graphs, created if missing")
+    parser.add_argument("--atol", type=float, default=1e-3)
+    parser.add_argument("--repeats", type=int, default=3, help="timed decodes per backend")
+    args = parser.parse_args()
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    chunked = not args.unchunked
+    torch.manual_seed(0)
+
+    reference = load_vae(device)
+    latent = torch.randn(args.batch_size, 64, args.frames, device=device)
+    with torch.inference_mode():
+        reference_audio = decode_audio(latent, reference, chunked=chunked)
+        reference_latent = encode_audio(reference_audio, reference, chunked=chunked)
+        times = {"torchscript": timed(lambda: decode_audio(latent, reference, chunked=chunked), args.repeats)}
+
+    failed = False
+    for backend in args.backends:
+        # every backend starts from a fresh torchscript module, onnx export moves it to cpu
+        s_t = time.time()
+        vae = load_vae_backend(load_vae(device), backend, device, onnx_dir=args.onnx_dir)
+        print(f"{backend} built in {time.time() - s_t:.2f}s")
+        with torch.inference_mode():
+            for name, diff in (
+                ("decode", (decode_audio(latent, vae, chunked=chunked) - reference_audio).abs().max().item()),
+                ("encode", (encode_audio(reference_audio, vae, chunked=chunked) - reference_latent).abs().max().item()),
+            ):
+                failed |= diff > args.atol
+                print(f"{backend:<12} {name} max abs diff {diff:.3e}{'  FAILED' if diff > args.atol else ''}")
+            times[backend] = timed(lambda: decode_audio(latent, vae, chunked=chunked), args.repeats)
+
+    seconds = args.frames * 2048 / 44100
+    for backend, elapsed in times.items():
+        print(
+            f"{backend:<12} {elapsed:.2f}s per decode of {args.batch_size} x {seconds:.0f}s audio, "
+            f"{times['torchscript'] / elapsed:.2f}x"
+        )
+
+    sys.exit(1 if failed else 0)
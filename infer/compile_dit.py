@@ -0,0 +1,88 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Ahead of time compilation of the dit for every duration bucket.
+
+    Runs a short dummy sampling per bucket and batch size so every graph is compiled once and
+    lands in the compile cache, workers started with the same --compile-cache, --bucket and
+    --precision then begin with warm graphs.
+
+    python3 infer/compile_dit.py --max-frames 6144 --bucket 256 --compile-cache ./pretrained/compile_cache
+    python3 infer/server.py --max-frames 6144 --compile --bucket 256 --compile-cache ./pretrained/compile_cache
+"""
+
+import argparse
+import time
+
+import torch
+
+from infer_utils import PrecisionPolicy, load_cfm
+from model.compile import bucket_length, compile_dit, enable_compile_cache, save_compile_cache
+
+
+def dummy_request(duration, device, dtype):
+    return dict(
+        cond=torch.zeros(1, duration, 64, device=device, dtype=dtype),
+        text=torch.zeros(1, duration, dtype=torch.long, device=device),
+        duration=duration,
+        style_prompt=torch.zeros(1, 512, device=device, dtype=dtype),
+        negative_style_prompt=torch.zeros(1, 512, device=device, dtype=dtype),
+        start_time=torch.zeros(1, device=device, dtype=dtype),
+        song_duration=torch.ones(1, device=device, dtype=dtype),
+        latent_pred_segments=[(0, duration)],
+    )
+
+
+def bucket_lengths(max_frames, bucket):
+    # the 2048 frame model always generates 95 s, the full model 96 to 285 s
+    if max_frames == 2048:
+        return [bucket_length(2048, bucket)]
+    min_frames = int(96 * 44100 / 2048)
+    return list(range(bucket_length(min_frames, bucket), bucket_length(max_frames, bucket) + 1, bucket))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-frames", type=int, default=2048, choices=[2048, 6144])
+    parser.add_argument("--bucket", type=int, default=256, help="durations are padded to a multiple of this")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1], help="request batch sizes to compile")
+    parser.add_argument("--compile-cache", type=str, default="./pretrained/compile_cache")
+    parser.add_argument("--compile-mode", type=str, default=None, help="torch.compile mode, e.g. max-autotune")
+    parser.add_argument(
+        "--precision", type=str, default="auto", choices=["auto", "benchmark", "fp32", "bf16", "fp16"], help="see infer.py"
+    )
+    parser.add_argument("--ckpt-path", type=str, default=None, help="cfm checkpoint, see infer.py")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    precision = PrecisionPolicy.from_name(device, args.precision)
+    print(precision)
+
+    enable_compile_cache(args.compile_cache)
+    repo_id = "ASLP-lab/DiffRhythm-1_2" if args.max_frames == 2048 else "ASLP-lab/DiffRhythm-1_2-full"
+    cfm = load_cfm(args.max_frames, device, repo_id, args.ckpt_path, precision.dtype)
+    compile_dit(cfm.transformer, mode=args.compile_mode)
+
+    for length in bucket_lengths(args.max_frames, args.bucket):
+        for batch_size in args.batch_sizes:
+            s_t = time.time()
+            requests = [dummy_request(length, device, precision.dtype)] * batch_size
+            with torch.inference_mode():
+                # guided steps run cond and null in one batch, unguided steps the cond branch alone
+                cfm.sample_batch(requests, steps=2, bucket=args.bucket)
+                cfm.sample_batch(requests, steps=2, cfg_strength=0.0, bucket=args.bucket)
+            print(f"bucket {length} batch {batch_size} compiled in {time.time() - s_t:.1f}s")
+
+    artifact_path = save_compile_cache(args.compile_cache)
+    print(f"compile cache in {args.compile_cache}" + (f", artifacts {artifact_path}" if artifact_path else ""))
@@ -0,0 +1,132 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Exports the weights of a cfm training checkpoint as an inference only safetensors file,
+    with the q/k/v and gate/up projections of the dit blocks stored fused like model.modules.LlamaBlock.
+
+    python3 infer/export_checkpoint.py --max-frames 2048 --output ./pretrained/cfm_model_fp16.safetensors
+    python3 infer/export_checkpoint.py --max-frames 2048 --device cpu --output ./pretrained/cfm_model_cpu.safetensors
+    python3 infer/infer.py --ckpt-path ./pretrained/cfm_model_fp16.safetensors ...
+
+    The weights are only mapped from disk when they are stored in the dtype inference runs in, a cpu
+    load in another dtype copies them. --dtype auto stores the dtype PrecisionPolicy picks for --device.
+
+    With --max-shard-size the weights are split into <name>-0000i-of-0000n.safetensors files
+    next to a <name>.safetensors.index.json, pass the index as --ckpt-path.
+"""
+
+import argparse
+import json
+import os
+
+import torch
+from huggingface_hub import hf_hub_download
+from safetensors.torch import save_file
+
+from infer_utils import PrecisionPolicy, checkpoint_state_dict
+from model.modules import fuse_llama_state_dict
+
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def parse_size(size):
+    units = {"KB": 2**10, "MB": 2**20, "GB": 2**30}
+    size = size.strip().upper()
+    for unit, scale in units.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * scale)
+    return int(size)
+
+
+def export_state_dict(state_dict, output, dtype, max_shard_size=None):
+    state_dict = {
+        k: (v.to(dtype) if v.is_floating_point() else v).contiguous()
+        for k, v in state_dict.items()
+        if isinstance(v, torch.Tensor)
+    }
+    # stored in the layout of the inference model, so its weights can be views of the mapped file
+    state_dict = fuse_llama_state_dict(state_dict)
+    metadata = {"format": "pt", "dtype": str(dtype).split(".")[-1]}
+
+    if max_shard_size is None:
+        save_file(state_dict, output, metadata=metadata)
+        return [output]
+
+    shards, current, current_size = [], {}, 0
+    for k, v in state_dict.items():
+        size = v.numel() * v.element_size()
+        if current and current_size + size > max_shard_size:
+            shards.append(current)
+            current, current_size = {}, 0
+        current[k] = v
+        current_size += size
+    shards.append(current)
+
+    stem = output[: -len(".safetensors")] if output.endswith(".safetensors") else output
+    weight_map, files = {}, []
+    for i, shard in enumerate(shards):
+        path = f"{stem}-{i + 1:05d}-of-{len(shards):05d}.safetensors"
+        save_file(shard, path, metadata=metadata)
+        weight_map.update({k: os.path.basename(path) for k in shard})
+        files.append(path)
+
+    index = {
+        "metadata": {"total_size": sum(v.numel() * v.element_size() for v in state_dict.values())},
+        "weight_map": weight_map,
+    }
+    with open(f"{stem}.safetensors.index.json", "w") as f:
+        json.dump(index, f, indent=2)
+    return files + [f"{stem}.safetensors.index.json"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--ckpt-path", type=str, default=None, help="training checkpoint, downloaded from the hub when not given"
+    )
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=2048,
+        choices=[2048, 6144],
+        help="picks the hub checkpoint when --ckpt-path is not given",
+    )
+    parser.add_argument("--output", type=str, required=True, help="output .safetensors path")
+    parser.add_argument(
+        "--dtype", type=str, default="auto", choices=["auto"] + list(DTYPES), help="auto: the dtype of --device"
+    )
+    parser.add_argument(
+        "--device", type=str, default=None, help="device inference runs on, default cuda if available"
+    )
+    parser.add_argument("--use-ema", action="store_true", help="export the ema weights")
+    parser.add_argument("--max-shard-size", type=str, default=None, help="e.g. 1GB, no sharding when not given")
+    args = parser.parse_args()
+
+    ckpt_path = args.ckpt_path
+    if ckpt_path is None:
+        repo_id = "ASLP-lab/DiffRhythm-1_2" if args.max_frames == 2048 else "ASLP-lab/DiffRhythm-1_2-full"
+        ckpt_path = hf_hub_download(repo_id=repo_id, filename="cfm_model.pt", cache_dir="./pretrained")
+
+    checkpoint = torch.load(ckpt_path, weights_only=True, mmap=True, map_location="cpu")
+    state_dict = checkpoint_state_dict(checkpoint, args.use_ema)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    max_shard_size = parse_size(args.max_shard_size) if args.max_shard_size else None
+    if args.dtype == "auto":
+        device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+        dtype = PrecisionPolicy.default_dtype(torch.device(device))
+    else:
+        dtype = DTYPES[args.dtype]
+    for path in export_state_dict(state_dict, args.output, dtype, max_shard_size):
+        print(path)
@@ -15,24 +15,30 @@
 # limitations under the License.
 
 import argparse
+import contextlib
+import json
 import os
 import time
-import random
 
 import torch
-import torchaudio
-from einops import rearrange
 
 print("Current working directory:", os.getcwd())
 
 from infer_utils import (
+    AUDIO_FORMATS,
+    BackgroundAudioWriter,
+    PrecisionPolicy,
+    StreamingAudioWriter,
     decode_audio,
     get_lrc_token,
     get_negative_style_prompt,
     get_reference_latent,
     get_style_prompt,
     prepare_model,
+    stream_audio,
+    to_int16,
 )
+from vae_backend import VAE_BACKENDS, load_vae_backend
 
 
 def inference(
@@ -48,8 +54,25 @@ def inference(
     batch_infer_num,
     song_duration,
     chunked=False,
+    steps=32,
+    solver="euler",
+    cfg_interval=(0.0, 1.0),
+    cfg_reuse_steps=0,
+    feature_cache_threshold=0.0,
+    bucket=None,
+    vae_context=None,
+    vae_micro_batch=1,
+    vae_workers=1,
+    stream_paths=None,
+    vae_device=None,
 ):
+    from model.dit import FeatureCache
+    from model.sampler import GuidanceSchedule, ODESampler
+
     with torch.inference_mode():
+        sampler = ODESampler(solver)
+        guidance = GuidanceSchedule(interval=cfg_interval, reuse_steps=cfg_reuse_steps)
+        feature_cache = FeatureCache(feature_cache_threshold) if feature_cache_threshold > 0 else None
         latents, _ = cfm_model.sample(
             cond=cond,
             text=text,
@@ -58,34 +81,54 @@ def inference(
             max_duration=duration,
             song_duration=song_duration, 
             negative_style_prompt=negative_style_prompt,
-            steps=32,
+            steps=steps,
             cfg_strength=4.0,
             start_time=start_time,
             latent_pred_segments=pred_frames,
-            batch_infer_num=batch_infer_num
+            batch_infer_num=batch_infer_num,
+            sampler=sampler,
+            guidance=guidance,
+            feature_cache=feature_cache,
+            bucket=bucket,
         )
+        print(f"sampling used {sampler.nfe} function evaluations")
+        if feature_cache is not None:
+            print(f"feature cache hits {feature_cache.hits}, misses {feature_cache.misses}")
 
-        outputs = []
-        for latent in latents:
-            latent = latent.to(torch.float32)
-            latent = latent.transpose(1, 2)  # [b d t]
+        if stream_paths is not None:
+            # every take is decoded chunk by chunk, loudness normalized and written to its own file
+            # as it goes, returns the number of samples per take
+            lengths = []
+            s_t = time.time()
+            with vae_context or contextlib.nullcontext():
+                for latent, stream_path in zip(latents, stream_paths):
+                    latent = latent.to(vae_device or latent.device)
+                    lengths.append(0)
+                    with StreamingAudioWriter(stream_path) as writer:
+                        for block in stream_audio(latent, vae_model, chunked=chunked, micro_batch=vae_micro_batch):
+                            if not any(lengths):
+                                print(f"first audio after {time.time() - s_t:.2f} seconds")
+                            writer.write(block)
+                            lengths[-1] += block.shape[-1]
+            return lengths
 
-            output = decode_audio(latent, vae_model, chunked=chunked)
+        audios = []
+        # vae_context moves an offloaded vae to the device for the decoding only
+        with vae_context or contextlib.nullcontext():
+            # the takes of one request share their length, chunked decoding runs them as one batch
+            takes = [torch.cat(latents)] if chunked else latents
+            for latent in takes:
+                latent = latent.to(vae_device or latent.device, torch.float32)
+                latent = latent.transpose(1, 2)  # [b d t]
 
-            # Rearrange audio batch to a single sequence
-            output = rearrange(output, "b d n -> d (b n)")
-            # Peak normalize, clip, convert to int16, and save to file
-            output = (
-                output.to(torch.float32)
-                .div(torch.max(torch.abs(output)))
-                .clamp(-1, 1)
-                .mul(32767)
-                .to(torch.int16)
-                .cpu()
-            )
-            outputs.append(output)
+                audios.append(
+                    decode_audio(
+                        latent, vae_model, chunked=chunked, micro_batch=vae_micro_batch, num_workers=vae_workers
+                    )
+                )
 
-        return outputs
+        # every take peak normalized and converted to int16 in one batch, one copy to the host
+        return list(to_int16(torch.cat(audios)))
 
 
 if __name__ == "__main__":
@@ -128,6 +171,19 @@ if __name__ == "__main__":
         default="infer/example/output",
         help="output directory fo generated song",
     )  # output directory of target song
+    parser.add_argument(
+        "--output-format",
+        type=str,
+        default="wav",
+        choices=["wav"] + list(AUDIO_FORMATS),
+        help="format of the generated songs, opus is written at 48 kHz",
+    )  # output format
+    parser.add_argument(
+        "--encode-workers",
+        type=int,
+        default=2,
+        help="threads encoding and writing the takes in the background",
+    )  # output encoding
     parser.add_argument(
         "--edit",
         action="store_true",
@@ -153,6 +209,151 @@ if __name__ == "__main__":
         required=False,
         help="number of songs per batch",
     )  # number of songs per batch
+    parser.add_argument(
+        "--steps",
+        type=int,
+        default=32,
+        help="number of points in the ode time grid",
+    )  # number of sampling steps
+    parser.add_argument(
+        "--solver",
+        type=str,
+        default="euler",
+        # model.sampler.SOLVERS, the model package is only imported once prepare_model loads it
+        choices=["euler", "midpoint", "heun", "dpm_multistep", "adaptive_heun"],
+        help="ode solver used for sampling",
+    )  # ode solver
+    parser.add_argument(
+        "--cfg-interval",
+        type=float,
+        nargs=2,
+        default=[0.0, 1.0],
+        metavar=("T_MIN", "T_MAX"),
+        help="apply classifier-free guidance only for t in [T_MIN, T_MAX], other steps skip the unconditional pass",
+    )  # guidance interval
+    parser.add_argument(
+        "--cfg-reuse-steps",
+        type=int,
+        default=0,
+        help="reuse the last unconditional prediction for this many guided steps before recomputing it",
+    )  # unconditional prediction reuse
+    parser.add_argument(
+        "--feature-cache-threshold",
+        type=float,
+        default=0.0,
+        help="reuse the cached transformer residual while the accumulated relative input change stays below this value, 0 disables",
+    )  # step-to-step feature caching
+    parser.add_argument(
+        "--ckpt-path",
+        type=str,
+        default=None,
+        help="cfm checkpoint, .pt training checkpoint or exported .safetensors / .safetensors.index.json, downloaded when not given",
+    )  # cfm checkpoint
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="none",
+        # "none" and model.quantization.QUANT_MODES
+        choices=["none", "int8-dynamic", "int8-weight"],
+        help="int8-dynamic: int8 weights and activations on cpu in fp32, int8-weight: int8 weights on any device",
+    )  # int8 quantization of the dit
+    parser.add_argument(
+        "--quant-config",
+        type=str,
+        default=None,
+        help="json from infer/calibrate_int8.py, its linears under skip stay in float",
+    )  # int8 calibration
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "benchmark", "fp32", "bf16", "fp16"],
+        help="dit dtype, auto: fp16 on gpu, bf16 on cpus with native bf16 else fp32, benchmark: fastest safe dtype",
+    )  # precision policy
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="torch.compile the dit, durations are padded to a multiple of --bucket frames",
+    )  # compiled dit
+    parser.add_argument(
+        "--bucket",
+        type=int,
+        default=256,
+        help="duration bucket in frames used with --compile",
+    )  # duration bucketing
+    parser.add_argument(
+        "--compile-cache",
+        type=str,
+        default="./pretrained/compile_cache",
+        help="on-disk compile cache, prefill it with infer/compile_dit.py",
+    )  # compile cache
+    parser.add_argument(
+        "--attention-chunk-size",
+        type=int,
+        default=None,
+        help="exact attention over chunks of this many frames, bounds attention memory for long songs on cpu",
+    )  # chunked attention
+    parser.add_argument(
+        "--ff-chunk-size",
+        type=int,
+        default=None,
+        help="run the dit feed-forward layers over chunks of this many frames, lowers peak activation memory",
+    )  # chunked feed-forward
+    parser.add_argument(
+        "--offload",
+        action="store_true",
+        help="stream dit blocks to the device per forward and keep muq and vae on cpu while idle",
+    )  # weight streaming
+    parser.add_argument(
+        "--vae-micro-batch",
+        type=int,
+        default=1,
+        help="overlapping chunks per vae call in chunked decoding, 0 for all chunks of all takes at once",
+    )  # batched chunk decoding
+    parser.add_argument(
+        "--vae-workers",
+        type=int,
+        default=1,
+        help="threads decoding vae micro batches concurrently, for cpu",
+    )  # batched chunk decoding
+    parser.add_argument(
+        "--vae-device",
+        type=str,
+        default=None,
+        help="device of the vae, e.g. a second gpu or cpu, default the dit device",
+    )  # vae placement
+    parser.add_argument(
+        "--vae-backend",
+        type=str,
+        default="torchscript",
+        choices=VAE_BACKENDS,
+        help="frozen: frozen and inference-optimized torchscript, onnx: onnxruntime, exported on first use",
+    )  # vae runtime
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write the takes progressively while they decode, loudness normalized instead of peak normalized",
+    )  # streaming decode
+    parser.add_argument(
+        "--attention-window",
+        type=int,
+        default=None,
+        help="local attention over this many frames on either side, for checkpoints fine-tuned with it",
+    )  # local attention
+    parser.add_argument(
+        "--global-layers",
+        type=int,
+        nargs="*",
+        default=[],
+        help="dit layers that keep full attention with --attention-window",
+    )  # local attention
+    parser.add_argument(
+        "--global-blocks",
+        type=int,
+        nargs="*",
+        default=[],
+        help="128 frame blocks, negative from the end, that every frame attends to with --attention-window",
+    )  # local attention
     args = parser.parse_args()
 
     assert (
@@ -166,11 +367,21 @@ if __name__ == "__main__":
             args.ref_song and args.edit_segments
         ), "reference song and edit segments should be provided for editing"
 
+    assert not (
+        args.stream and args.output_format == "opus"
+    ), "--stream writes at 44.1 kHz, which opus does not support"
+
+    assert not (
+        args.offload and (args.compile or args.quantize != "none" or args.vae_backend != "torchscript")
+    ), "--offload cannot be combined with --compile, --quantize or --vae-backend"
+
     device = "cpu"
-    if torch.cuda.is_available():
-        device = "cuda"
-    elif torch.mps.is_available():
-        device = "mps"
+    # int8 dynamic quantized gemms only run on cpu
+    if args.quantize != "int8-dynamic":
+        if torch.cuda.is_available():
+            device = "cuda"
+        elif torch.mps.is_available():
+            device = "mps"
 
     audio_length = args.audio_length
     if audio_length == 95:
@@ -183,23 +394,69 @@ if __name__ == "__main__":
             "Supported values are exactly 95 or any value between 96 and 285 (inclusive)."
         )
 
-    cfm, tokenizer, muq, vae = prepare_model(max_frames, device)
+    # int8 dynamic quantization starts from fp32
+    if args.quantize == "int8-dynamic":
+        precision = PrecisionPolicy(device, torch.float32)
+    else:
+        precision = PrecisionPolicy.from_name(device, args.precision)
+    print(precision)
+    cfm, tokenizer, muq, vae = prepare_model(
+        max_frames, device, ckpt_path=args.ckpt_path, dtype=precision.dtype, offload=args.offload
+    )
+    vae_device = args.vae_device or device
+    if args.offload:
+        from model.offload import IdleOffload
+
+        muq_context = IdleOffload(muq, device)
+        vae_context = IdleOffload(vae, vae_device)
+    else:
+        muq_context = vae_context = contextlib.nullcontext()
+        vae = load_vae_backend(vae.to(vae_device), args.vae_backend, vae_device)
+    cfm.transformer.attention_chunk_size = args.attention_chunk_size
+    cfm.transformer.set_attention_window(args.attention_window, args.global_layers, global_blocks=args.global_blocks)
+    cfm.transformer.set_ff_chunk_size(args.ff_chunk_size)
+    if args.quantize != "none":
+        from model.quantization import quantize_dit
+
+        skip = ()
+        if args.quant_config:
+            with open(args.quant_config) as f:
+                skip = json.load(f)["skip"]
+        quantize_dit(cfm.transformer, args.quantize, skip=skip)
+    if args.compile:
+        from model.compile import compile_dit, enable_compile_cache
+
+        enable_compile_cache(args.compile_cache)
+        compile_dit(cfm.transformer)
 
     if args.lrc_path:
         with open(args.lrc_path, "r", encoding='utf-8') as f:
             lrc = f.read()
     else:
         lrc = ""
-    lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(max_frames, lrc, tokenizer, audio_length, device)
+    lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(
+        max_frames, lrc, tokenizer, audio_length, device, dtype=precision.dtype
+    )
 
-    if args.ref_audio_path:
-        style_prompt = get_style_prompt(muq, args.ref_audio_path)
-    else:
-        style_prompt = get_style_prompt(muq, prompt=args.ref_prompt)
+    with muq_context:
+        if args.ref_audio_path:
+            style_prompt = get_style_prompt(muq, args.ref_audio_path, dtype=precision.dtype)
+        else:
+            style_prompt = get_style_prompt(muq, prompt=args.ref_prompt, dtype=precision.dtype)
 
-    negative_style_prompt = get_negative_style_prompt(device)
+    negative_style_prompt = get_negative_style_prompt(device, dtype=precision.dtype)
 
-    latent_prompt, pred_frames = get_reference_latent(device, max_frames, args.edit, args.edit_segments, args.ref_song, vae)
+    with vae_context:
+        latent_prompt, pred_frames = get_reference_latent(
+            device, max_frames, args.edit, args.edit_segments, args.ref_song, vae, vae_device=vae_device
+        )
+
+    output_dir = args.output_dir
+    os.makedirs(output_dir, exist_ok=True)
+    file_names = [
+        f"output_{i}.{args.output_format}" if args.batch_infer_num > 1 else f"output.{args.output_format}"
+        for i in range(args.batch_infer_num)
+    ]
 
     s_t = time.time()
     generated_songs = inference(
@@ -214,15 +471,41 @@ if __name__ == "__main__":
         pred_frames=pred_frames,
         chunked=args.chunked,
         batch_infer_num=args.batch_infer_num,
-        song_duration=song_duration
+        song_duration=song_duration,
+        steps=args.steps,
+        solver=args.solver,
+        cfg_interval=args.cfg_interval,
+        cfg_reuse_steps=args.cfg_reuse_steps,
+        feature_cache_threshold=args.feature_cache_threshold,
+        bucket=args.bucket if args.compile else None,
+        vae_context=vae_context,
+        vae_micro_batch=args.vae_micro_batch or None,
+        vae_workers=args.vae_workers,
+        stream_paths=[os.path.join(output_dir, name) for name in file_names] if args.stream else None,
+        vae_device=vae_device,
     )
     e_t = time.time() - s_t
     print(f"inference cost {e_t:.2f} seconds")
-    
-    generated_song = random.sample(generated_songs, 1)[0]
 
-    output_dir = args.output_dir
-    os.makedirs(output_dir, exist_ok=True)
-
-    output_path = os.path.join(output_dir, "output.wav")
-    torchaudio.save(output_path, generated_song, sample_rate=44100)
+    # every take is kept, encoded on background threads and listed in the manifest
+    request = dict(
+        lrc_path=args.lrc_path,
+        ref_prompt=args.ref_prompt,
+        ref_audio_path=args.ref_audio_path,
+        audio_length=args.audio_length,
+        edit=args.edit,
+        ref_song=args.ref_song,
+        edit_segments=args.edit_segments,
+        steps=args.steps,
+        solver=args.solver,
+    )
+    with BackgroundAudioWriter(
+        output_dir, num_workers=args.encode_workers, request=request, inference_seconds=round(e_t, 2)
+    ) as writer:
+        for i, (file_name, generated_song) in enumerate(zip(file_names, generated_songs)):
+            if args.stream:
+                # already written while decoding, generated_song is its number of samples
+                writer.add_written(file_name, 2, generated_song, take=i, normalization="loudness")
+            else:
+                writer.submit(file_name, generated_song, take=i, normalization="peak")
+    print(f"{len(generated_songs)} songs written to {output_dir}, see {writer.manifest_path}")
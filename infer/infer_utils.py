@@ -15,20 +15,116 @@
 # limitations under the License.
 
 import torch
-import librosa
-import torchaudio
 import random
 import json
-from muq import MuQMuLan
-from mutagen.mp3 import MP3
 import os
+import threading
+import time
 import numpy as np
+from einops import rearrange
+from concurrent.futures import ThreadPoolExecutor
 from huggingface_hub import hf_hub_download
 
 from sys import path
 path.append(os.getcwd())
 
-from model import DiT, CFM
+# librosa, torchaudio, muq and the model code (transformers) are imported where they are used,
+# so prepare_model can pull them in concurrently with checkpoint loading
+
+class PrecisionPolicy:
+    """
+    dtype the dit and its conditioning run in on a device.
+    cuda / mps - fp16
+    cpu        - bf16 when the cpu has native bf16 (avx512_bf16 / amx_bf16), fp32 otherwise,
+                 fp16 is emulated on cpu and never picked
+    CFM keeps the ode state and time grid in fp32 whatever the model dtype.
+    """
+
+    DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+    def __init__(self, device, dtype=None):
+        self.device = torch.device(device)
+        self.dtype = dtype if dtype is not None else self.default_dtype(self.device)
+
+    def __repr__(self):
+        return f"PrecisionPolicy(device={self.device}, dtype={self.dtype})"
+
+    @staticmethod
+    def cpu_has_native_bf16():
+        try:
+            with open("/proc/cpuinfo") as f:
+                flags = f.read()
+            return "avx512_bf16" in flags or "amx_bf16" in flags
+        except OSError:
+            return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+    @classmethod
+    def default_dtype(cls, device):
+        if device.type == "cpu":
+            return torch.bfloat16 if cls.cpu_has_native_bf16() else torch.float32
+        return torch.float16
+
+    @classmethod
+    def safe_dtypes(cls, device):
+        if device.type == "cpu":
+            return [torch.float32] + ([torch.bfloat16] if cls.cpu_has_native_bf16() else [])
+        dtypes = [torch.float16, torch.float32]
+        if device.type == "cuda" and torch.cuda.is_bf16_supported():
+            dtypes.insert(1, torch.bfloat16)
+        return dtypes
+
+    @classmethod
+    def benchmark(cls, device, dim=1024, tokens=256, repeats=3):
+        # times a dit sized feed forward in every safe dtype and keeps the fastest one whose
+        # output stays close to fp32
+        device = torch.device(device)
+
+        def sync():
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            elif device.type == "mps":
+                torch.mps.synchronize()
+
+        generator = torch.Generator().manual_seed(0)
+        x = torch.randn(tokens, dim, generator=generator)
+        w1 = torch.randn(4 * dim, dim, generator=generator) / dim**0.5
+        w2 = torch.randn(dim, 4 * dim, generator=generator) / (4 * dim) ** 0.5
+
+        def feed_forward(dtype):
+            xs, w1s, w2s = (t.to(device, dtype) for t in (x, w1, w2))
+            return torch.nn.functional.linear(torch.nn.functional.silu(torch.nn.functional.linear(xs, w1s)), w2s)
+
+        timings = {}
+        with torch.inference_mode():
+            # every candidate, fp16 included, is checked against fp32
+            reference = feed_forward(torch.float32).cpu()
+            for dtype in cls.safe_dtypes(device):
+                out = feed_forward(dtype)
+                sync()
+                s_t = time.time()
+                for _ in range(repeats):
+                    feed_forward(dtype)
+                sync()
+                elapsed = (time.time() - s_t) / repeats
+                out = out.float().cpu()
+                error = ((out - reference).norm() / reference.norm()).item()
+                if torch.isfinite(out).all() and error < 1e-2:
+                    timings[dtype] = elapsed
+
+        # fp32 when no candidate passes the check
+        dtype = min(timings, key=timings.get) if timings else torch.float32
+        print("precision benchmark " + ", ".join(f"{str(k).split('.')[-1]} {v * 1e3:.2f}ms" for k, v in timings.items()))
+        return cls(device, dtype)
+
+    @classmethod
+    def from_name(cls, device, name="auto"):
+        # auto, benchmark, fp32, bf16 or fp16
+        if name == "auto":
+            return cls(device)
+        if name == "benchmark":
+            return cls.benchmark(device)
+        return cls(device, cls.DTYPES[name])
+
 
 def vae_sample(mean, scale):
     stdev = torch.nn.functional.softplus(scale) + 1e-4
@@ -78,6 +174,8 @@ class PadCrop(torch.nn.Module):
 
 def prepare_audio(audio, in_sr, target_sr, target_length, target_channels, device):
     
+    import torchaudio
+
     audio = audio.to(device)
 
     if in_sr != target_sr:
@@ -97,7 +195,29 @@ def prepare_audio(audio, in_sr, target_sr, target_length, target_channels, devic
 
     return audio
 
-def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128):
+def _run_chunks(fn, chunks, micro_batch=1, num_workers=1):
+    # chunks [num_chunks b ...] -> list of num_chunks outputs [b ...], fn is called on micro_batch
+    # chunks at a time (None for all at once), concatenated along the batch, on num_workers threads
+    num_chunks, batch = chunks.shape[0], chunks.shape[1]
+    micro_batch = micro_batch or num_chunks
+    groups = [chunks[i : i + micro_batch].flatten(0, 1) for i in range(0, num_chunks, micro_batch)]
+
+    def run(group):
+        # grad mode is thread local
+        with torch.no_grad():
+            return fn(group)
+
+    if num_workers > 1 and len(groups) > 1:
+        with ThreadPoolExecutor(min(num_workers, len(groups)), thread_name_prefix="vae") as pool:
+            outputs = list(pool.map(run, groups))
+    else:
+        outputs = [run(group) for group in groups]
+    return [y for output in outputs for y in output.split(batch, dim=0)]
+
+
+def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128, micro_batch=1, num_workers=1):
+    # micro_batch - overlapping chunks decoded per vae call, None for all chunks of the batch at once
+    # num_workers - threads decoding micro batches concurrently, for cpu
     downsampling_ratio = 2048
     io_channels = 2
     if not chunked:
@@ -123,10 +243,9 @@ def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128):
         # Create an empty waveform, we will populate it with chunks as decode them
         y_size = total_size * samples_per_latent
         y_final = torch.zeros((batch_size, io_channels, y_size)).to(latents.device)
+        y_chunks = _run_chunks(vae_model.decode_export, chunks, micro_batch, num_workers)
         for i in range(num_chunks):
-            x_chunk = chunks[i, :]
-            # decode the chunk
-            y_chunk = vae_model.decode_export(x_chunk)
+            y_chunk = y_chunks[i]
             # figure out where to put the audio along the time domain
             if i == num_chunks - 1:
                 # final chunk always goes at the end
@@ -151,7 +270,229 @@ def decode_audio(latents, vae_model, chunked=False, overlap=32, chunk_size=128):
             y_final[:, :, t_start:t_end] = y_chunk[:, :, chunk_start:chunk_end]
         return y_final
 
-def encode_audio(audio, vae_model, chunked=False, overlap=32, chunk_size=128):
+def decode_audio_stream(latents, vae_model, chunked=True, overlap=32, chunk_size=128, micro_batch=1):
+    """
+    Generator version of decode_audio, yields [b c t] audio blocks in order as soon as they are
+    final, their concatenation along t equals decode_audio(latents, vae_model, chunked).
+    micro_batch overlapping chunks are decoded per vae call, None for all at once.
+    """
+    if not chunked:
+        yield vae_model.decode_export(latents)
+        return
+
+    samples_per_latent = 2048
+    hop_size = chunk_size - overlap
+    total_size = latents.shape[2]
+    y_size = total_size * samples_per_latent
+    ol = (overlap // 2) * samples_per_latent
+
+    # same chunking as decode_audio, the final chunk always ends at the end of the song
+    chunks = [latents[:, :, i : i + chunk_size] for i in range(0, total_size - chunk_size + 1, hop_size)]
+    if not chunks or (len(chunks) - 1) * hop_size + chunk_size != total_size:
+        chunks.append(latents[:, :, -chunk_size:])
+    num_chunks = len(chunks)
+
+    # sample range [start, end) of every decoded chunk and the part of it that is kept
+    spans = []
+    for i, chunk in enumerate(chunks):
+        if i == num_chunks - 1:
+            t_end = y_size
+            t_start = t_end - chunk.shape[2] * samples_per_latent
+        else:
+            t_start = i * hop_size * samples_per_latent
+            t_end = t_start + chunk_size * samples_per_latent
+        keep_start = t_start + ol if i > 0 else t_start
+        keep_end = t_end - ol if i < num_chunks - 1 else t_end
+        spans.append((t_start, keep_start, keep_end))
+    # a later chunk overwrites what it overlaps (the final one may reach back), so every chunk
+    # only emits up to the first sample kept by any later chunk
+    emit_end = [span[2] for span in spans]
+    later_start = y_size
+    for i in range(num_chunks - 1, -1, -1):
+        emit_end[i] = min(emit_end[i], later_start)
+        later_start = min(later_start, spans[i][1])
+
+    micro_batch = micro_batch or num_chunks
+    emitted = 0
+    for group_start in range(0, num_chunks, micro_batch):
+        group = torch.stack(chunks[group_start : group_start + micro_batch])
+        for i, y_chunk in enumerate(_run_chunks(vae_model.decode_export, group, micro_batch=None), start=group_start):
+            t_start = spans[i][0]
+            if emit_end[i] > emitted:
+                yield y_chunk[:, :, emitted - t_start : emit_end[i] - t_start]
+                emitted = emit_end[i]
+
+
+class StreamingLoudnessNormalizer:
+    """
+    Loudness normalization for audio that arrives in blocks, where the peak of the whole song used by
+    the offline peak normalization is not known yet. The gain brings the running rms level of all
+    audio seen so far to target_db dBFS, is limited so the block peaks stay below peak_db and is
+    ramped linearly across every block to avoid steps. Rms based, not k-weighted lufs.
+    """
+
+    def __init__(self, target_db=-16.0, peak_db=-1.0, max_gain_db=30.0):
+        self.target = 10 ** (target_db / 20)
+        self.peak = 10 ** (peak_db / 20)
+        self.max_gain = 10 ** (max_gain_db / 20)
+        self.sum_sq = 0.0
+        self.count = 0
+        self.gain = None
+
+    def __call__(self, block):
+        # float [c t] -> normalized float [c t], clamped to [-1, 1]
+        block = block.to(torch.float32)
+        self.sum_sq += block.pow(2).sum().item()
+        self.count += block.numel()
+        rms = (self.sum_sq / max(self.count, 1)) ** 0.5
+        peak_gain = self.peak / max(block.abs().max().item(), 1e-8)
+        gain = min(self.target / max(rms, 1e-8), self.max_gain, peak_gain)
+        # the ramp starts at the previous gain, which a louder block must not exceed either
+        start_gain = gain if self.gain is None else min(self.gain, peak_gain)
+        self.gain = gain
+        ramp = torch.linspace(start_gain, gain, block.shape[-1], device=block.device)
+        return (block * ramp).clamp(-1, 1)
+
+
+# soundfile (format, subtype) of the compressed output formats, opus only takes 8 to 48 kHz
+AUDIO_FORMATS = {"flac": ("FLAC", "PCM_16"), "mp3": ("MP3", "MPEG_LAYER_III"), "opus": ("OGG", "OPUS")}
+
+
+class StreamingAudioWriter:
+    """
+    Writes int16 [c t] blocks to a file as they come, wav through the standard library,
+    flac, mp3 and opus (see AUDIO_FORMATS) through soundfile.
+    """
+
+    def __init__(self, path, sample_rate=44100, channels=2):
+        self.path = path
+        self.format = os.path.splitext(path)[-1].lower().lstrip(".")
+        if self.format == "wav":
+            import wave
+
+            self.file = wave.open(path, "wb")
+            self.file.setnchannels(channels)
+            self.file.setsampwidth(2)
+            self.file.setframerate(sample_rate)
+        else:
+            import soundfile
+
+            file_format, subtype = AUDIO_FORMATS.get(self.format, (None, "PCM_16"))
+            self.file = soundfile.SoundFile(
+                path, "w", samplerate=sample_rate, channels=channels, format=file_format, subtype=subtype
+            )
+
+    def write(self, block):
+        frames = block.t().contiguous().cpu().numpy()
+        if self.format == "wav":
+            self.file.writeframes(frames.tobytes())
+        else:
+            self.file.write(frames)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def save_audio(path, audio, sample_rate=44100):
+    # int16 [c n] on cpu -> file, the format follows the extension, opus is resampled to 48 kHz,
+    # returns the sample rate of the file
+    if path.endswith(".opus"):
+        import torchaudio
+
+        audio = torchaudio.functional.resample(audio.to(torch.float32), sample_rate, 48000)
+        audio = audio.round().clamp(-32768, 32767).to(torch.int16)
+        sample_rate = 48000
+    with StreamingAudioWriter(path, sample_rate, channels=audio.shape[0]) as writer:
+        writer.write(audio)
+    return sample_rate
+
+
+class BackgroundAudioWriter:
+    """
+    Encodes and writes takes on a thread pool while the caller goes on, and lists them in a
+    manifest json once closed. submit() takes int16 [c n] audio on cpu plus any json fields
+    recorded with the take, close() waits for all files and returns the manifest.
+    """
+
+    def __init__(self, output_dir, num_workers=2, sample_rate=44100, manifest_name="manifest.json", **info):
+        self.output_dir = output_dir
+        self.sample_rate = sample_rate
+        self.manifest_path = os.path.join(output_dir, manifest_name)
+        self.info = info
+        self.pool = ThreadPoolExecutor(max(num_workers, 1), thread_name_prefix="encode")
+        self.entries = []
+
+    def _write(self, path, audio):
+        s_t = time.time()
+        sample_rate = save_audio(path, audio, self.sample_rate)
+        return sample_rate, time.time() - s_t
+
+    def submit(self, file_name, audio, **fields):
+        path = os.path.join(self.output_dir, file_name)
+        entry = dict(
+            path=file_name,
+            format=os.path.splitext(file_name)[-1].lstrip("."),
+            channels=audio.shape[0],
+            duration=audio.shape[-1] / self.sample_rate,
+            **fields,
+        )
+        self.entries.append((entry, self.pool.submit(self._write, path, audio)))
+
+    def add_written(self, file_name, channels, num_samples, sample_rate=None, **fields):
+        # lists a file written elsewhere, e.g. streamed while decoding
+        entry = dict(
+            path=file_name,
+            format=os.path.splitext(file_name)[-1].lstrip("."),
+            channels=channels,
+            duration=num_samples / (sample_rate or self.sample_rate),
+            sample_rate=sample_rate or self.sample_rate,
+            **fields,
+        )
+        self.entries.append((entry, None))
+
+    def close(self):
+        outputs = []
+        for entry, future in self.entries:
+            if future is None:
+                outputs.append(entry)
+                continue
+            try:
+                # opus files are written at 48 kHz
+                entry["sample_rate"], elapsed = future.result()
+                entry["encode_seconds"] = round(elapsed, 3)
+            except Exception as e:
+                entry["error"] = repr(e)
+            outputs.append(entry)
+        self.pool.shutdown()
+        manifest = dict(self.info, outputs=outputs)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2, ensure_ascii=False)
+        return manifest
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def stream_audio(latent, vae_model, chunked=True, micro_batch=1, normalizer=None):
+    # [1 n d] latent -> int16 [c t] blocks on cpu, loudness normalized while decoding
+    normalizer = normalizer or StreamingLoudnessNormalizer()
+    latent = latent.to(torch.float32).transpose(1, 2)  # [b d t]
+    for block in decode_audio_stream(latent, vae_model, chunked=chunked, micro_batch=micro_batch):
+        yield normalizer(block[0]).mul(32767).to(torch.int16).cpu()
+
+
+def encode_audio(audio, vae_model, chunked=False, overlap=32, chunk_size=128, micro_batch=1, num_workers=1):
     downsampling_ratio = 2048
     latent_dim = 128
     if not chunked:
@@ -182,10 +523,9 @@ def encode_audio(audio, vae_model, chunked=False, overlap=32, chunk_size=128):
         y_size = total_size // samples_per_latent
         # Create an empty latent, we will populate it with chunks as we encode them
         y_final = torch.zeros((batch_size,latent_dim,y_size)).to(audio.device)
+        y_chunks = _run_chunks(vae_model.encode_export, chunks, micro_batch, num_workers)
         for i in range(num_chunks):
-            x_chunk = chunks[i,:]
-            # encode the chunk
-            y_chunk = vae_model.encode_export(x_chunk)
+            y_chunk = y_chunks[i]
             # figure out where to put the audio along the time domain
             if i == num_chunks-1:
                 # final chunk always goes at the end
@@ -210,62 +550,114 @@ def encode_audio(audio, vae_model, chunked=False, overlap=32, chunk_size=128):
             y_final[:,:,t_start:t_end] = y_chunk[:,:,chunk_start:chunk_end]
         return y_final
 
-def prepare_model(max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2"):
-    # prepare cfm model
-    if max_frames == 2048:
-        repo_id = "ASLP-lab/DiffRhythm-1_2"
-    else:
-        repo_id = "ASLP-lab/DiffRhythm-1_2-full"
-        
-    dit_ckpt_path = hf_hub_download(
-        repo_id=repo_id, filename="cfm_model.pt", cache_dir="./pretrained"
-    )
-        
+def load_cfm(max_frames, device, repo_id, ckpt_path=None, dtype=None):
+    from model import DiT, CFM
+
     dit_config_path = "./config/diffrhythm-1b.json"
     with open(dit_config_path) as f:
         model_config = json.load(f)
     dit_model_cls = DiT
-    cfm = CFM(
-        transformer=dit_model_cls(**model_config["model"], max_frames=max_frames),
-        num_channels=model_config["model"]["mel_dim"],
-        max_frames=max_frames
-    )
+
+    def build():
+        return CFM(
+            transformer=dit_model_cls(**model_config["model"], max_frames=max_frames),
+            num_channels=model_config["model"]["mel_dim"],
+            max_frames=max_frames
+        )
+
+    if ckpt_path is not None and ckpt_path.endswith((".safetensors", ".index.json")):
+        # exported inference checkpoint, weights are mapped from disk into a meta-initialized model
+        return load_exported_checkpoint(build, ckpt_path, device, dtype=dtype)
+
+    if ckpt_path is None:
+        ckpt_path = hf_hub_download(
+            repo_id=repo_id, filename="cfm_model.pt", cache_dir="./pretrained"
+        )
+    cfm = build()
     cfm = cfm.to(device)
-    cfm = load_checkpoint(cfm, dit_ckpt_path, device=device, use_ema=False)
+    cfm = load_checkpoint(cfm, ckpt_path, device=device, use_ema=False, dtype=dtype or torch.float16)
+    return cfm
 
-    # prepare tokenizer
-    tokenizer = CNENTokenizer()
 
-    # prepare muq
+def load_muq(device):
+    from muq import MuQMuLan
+
     muq = MuQMuLan.from_pretrained("OpenMuQ/MuQ-MuLan-large", cache_dir="./pretrained")
     muq = muq.to(device).eval()
+    return muq
+
 
-    # prepare vae
+def load_vae(device):
     vae_ckpt_path = hf_hub_download(
         repo_id="ASLP-lab/DiffRhythm-vae",
         filename="vae_model.pt",
         cache_dir="./pretrained",
     )
     vae = torch.jit.load(vae_ckpt_path, map_location="cpu").to(device)
+    return vae
 
-    return cfm, tokenizer, muq, vae
+
+def prepare_model(
+    max_frames, device, repo_id="ASLP-lab/DiffRhythm-1_2", num_workers=4, ckpt_path=None, dtype=None, offload=False
+):
+    # offload: dit blocks are streamed to device per forward (model.offload.BlockStreamer), muq and vae
+    # are returned on cpu for model.offload.IdleOffload
+    # prepare cfm model
+    if max_frames == 2048:
+        repo_id = "ASLP-lab/DiffRhythm-1_2"
+    else:
+        repo_id = "ASLP-lab/DiffRhythm-1_2-full"
+
+    # downloads, checkpoint reads and imports of the four components overlap
+    load_device = "cpu" if offload else device
+    loaders = {
+        "cfm": lambda: load_cfm(max_frames, load_device, repo_id, ckpt_path, dtype),
+        "tokenizer": CNENTokenizer,
+        "muq": lambda: load_muq(load_device),
+        "vae": lambda: load_vae(load_device),
+    }
+    elapsed = {}
+
+    def timed(name):
+        s_t = time.time()
+        out = loaders[name]()
+        elapsed[name] = time.time() - s_t
+        return out
+
+    s_t = time.time()
+    with ThreadPoolExecutor(max(num_workers, 1), thread_name_prefix="load") as pool:
+        futures = {name: pool.submit(timed, name) for name in loaders}
+        models = {name: future.result() for name, future in futures.items()}
+    report = ", ".join(f"{name} {elapsed[name]:.2f}s" for name in loaders)
+    print(f"startup {time.time() - s_t:.2f}s ({report})")
+
+    if offload:
+        from model.offload import BlockStreamer
+
+        # exported checkpoints stay mapped from disk, others are pinned for asynchronous copies
+        exported = ckpt_path is not None and ckpt_path.endswith((".safetensors", ".index.json"))
+        BlockStreamer(models["cfm"].transformer, device, pin_memory=not exported)
+
+    return models["cfm"], models["tokenizer"], models["muq"], models["vae"]
 
 
 # for song edit, will be added in the future
-def get_reference_latent(device, max_frames, edit, pred_segments, ref_song, vae_model):
+def get_reference_latent(device, max_frames, edit, pred_segments, ref_song, vae_model, vae_device=None):
     sampling_rate = 44100
     downsample_rate = 2048
     io_channels = 2
     if edit:
+        import torchaudio
+
         input_audio, in_sr = torchaudio.load(ref_song)
-        input_audio = prepare_audio(input_audio, in_sr=in_sr, target_sr=sampling_rate, target_length=None, target_channels=io_channels, device=device)
+        input_audio = prepare_audio(input_audio, in_sr=in_sr, target_sr=sampling_rate, target_length=None, target_channels=io_channels, device=vae_device or device)
         input_audio = normalize_audio(input_audio, -6)
         
         with torch.no_grad():
             latent = encode_audio(input_audio, vae_model, chunked=True) # [b d t]
             mean, scale = latent.chunk(2, dim=1)
             prompt, _ = vae_sample(mean, scale)
-            prompt = prompt.transpose(1, 2) # [b t d]
+            prompt = prompt.transpose(1, 2).to(device) # [b t d]
         
         pred_segments = json.loads(pred_segments)
         
@@ -282,22 +674,99 @@ def get_reference_latent(device, max_frames, edit, pred_segments, ref_song, vae_
         return prompt, pred_frames
 
 
-def get_negative_style_prompt(device):
+def audio_length_to_max_frames(audio_length):
+    if audio_length == 95:
+        return 2048
+    elif 95 < audio_length <= 285:
+        return 6144
+    raise ValueError(
+        f"Invalid audio_length: {audio_length}. "
+        "Supported values are exactly 95 or any value between 96 and 285 (inclusive)."
+    )
+
+
+def prepare_request(
+    params, max_frames, tokenizer, muq, vae, negative_style_prompt, device, dtype=torch.float16, vae_device=None
+):
+    # json style request (see infer/server.py) -> request dict of CFM.sample_batch
+    audio_length = params.get("audio_length", 95)
+    if audio_length_to_max_frames(audio_length) != max_frames:
+        raise ValueError(f"audio_length {audio_length} is not served by this {max_frames} frame model")
+    ref_prompt, ref_audio_path = params.get("ref_prompt"), params.get("ref_audio_path")
+    if bool(ref_prompt) == bool(ref_audio_path):
+        raise ValueError("exactly one of ref_prompt or ref_audio_path should be provided")
+    edit = params.get("edit", False)
+    if edit and not (params.get("ref_song") and params.get("edit_segments")):
+        raise ValueError("reference song and edit segments should be provided for editing")
+
+    lrc_prompt, start_time, end_frame, song_duration = get_lrc_token(
+        max_frames, params.get("lrc", ""), tokenizer, audio_length, device, dtype=dtype
+    )
+    if ref_audio_path:
+        style_prompt = get_style_prompt(muq, ref_audio_path, dtype=dtype)
+    else:
+        style_prompt = get_style_prompt(muq, prompt=ref_prompt, dtype=dtype)
+    latent_prompt, pred_frames = get_reference_latent(
+        device, max_frames, edit, params.get("edit_segments"), params.get("ref_song"), vae, vae_device=vae_device
+    )
+
+    return dict(
+        cond=latent_prompt,
+        text=lrc_prompt,
+        duration=end_frame,
+        style_prompt=style_prompt,
+        negative_style_prompt=negative_style_prompt,
+        start_time=start_time,
+        song_duration=song_duration,
+        latent_pred_segments=pred_frames,
+        seed=params.get("seed"),
+        steps=params.get("steps", 32),
+        cfg_strength=params.get("cfg_strength", 4.0),
+    )
+
+
+def to_int16(audio):
+    # [b c n] -> int16 [b c n] on cpu, every item peak normalized by itself on the device, one host copy
+    audio = audio.to(torch.float32)
+    peak = audio.abs().amax(dim=(1, 2), keepdim=True).clamp_min(1e-8)
+    return audio.div(peak).clamp(-1, 1).mul(32767).to(torch.int16).cpu()
+
+
+def latent_to_audio(latent, vae_model, chunked=True, micro_batch=1, num_workers=1):
+    # [b n d] latent -> peak normalized int16 [c (b n)] audio on cpu
+    latent = latent.to(torch.float32).transpose(1, 2)  # [b d t]
+    output = decode_audio(latent, vae_model, chunked=chunked, micro_batch=micro_batch, num_workers=num_workers)
+    output = rearrange(output, "b d n -> d (b n)")
+    output = (
+        output.to(torch.float32)
+        .div(torch.max(torch.abs(output)))
+        .clamp(-1, 1)
+        .mul(32767)
+        .to(torch.int16)
+        .cpu()
+    )
+    return output
+
+
+def get_negative_style_prompt(device, dtype=torch.float16):
     file_path = "infer/example/vocal.npy"
     vocal_stlye = np.load(file_path)
 
     vocal_stlye = torch.from_numpy(vocal_stlye).to(device)  # [1, 512]
-    vocal_stlye = vocal_stlye.half()
+    vocal_stlye = vocal_stlye.to(dtype)
 
     return vocal_stlye
 
 
 @torch.no_grad()
-def get_style_prompt(model, wav_path=None, prompt=None):
+def get_style_prompt(model, wav_path=None, prompt=None, dtype=torch.float16):
     mulan = model
 
     if prompt is not None:
-        return mulan(texts=prompt).half()
+        return mulan(texts=prompt).to(dtype)
+
+    import librosa
+    from mutagen.mp3 import MP3
 
     ext = os.path.splitext(wav_path)[-1].lower()
     if ext == ".mp3":
@@ -325,7 +794,7 @@ def get_style_prompt(model, wav_path=None, prompt=None):
         audio_emb = mulan(wavs=wav)  # [1, 512]
 
     audio_emb = audio_emb
-    audio_emb = audio_emb.half()
+    audio_emb = audio_emb.to(dtype)
 
     return audio_emb
 
@@ -353,9 +822,13 @@ class CNENTokenizer:
         from g2p.g2p_generation import chn_eng_g2p
 
         self.tokenizer = chn_eng_g2p
+        # phonemizer's espeak backend, jieba and the polyphone onnx session are not thread safe,
+        # concurrent requests (infer/server.py front pool) tokenize one at a time
+        self.lock = threading.Lock()
 
     def encode(self, text):
-        phone, token = self.tokenizer(text)
+        with self.lock:
+            phone, token = self.tokenizer(text)
         token = [x + 1 for x in token]
         return token
 
@@ -363,7 +836,7 @@ class CNENTokenizer:
         return "|".join([self.id2phone[x - 1] for x in token])
 
 
-def get_lrc_token(max_frames, text, tokenizer, max_secs, device):
+def get_lrc_token(max_frames, text, tokenizer, max_secs, device, dtype=torch.float16):
 
     lyrics_shift = 0
     sampling_rate = 44100
@@ -423,16 +896,101 @@ def get_lrc_token(max_frames, text, tokenizer, max_secs, device):
     lrc_emb = lrc.unsqueeze(0).to(device)
 
     normalized_start_time = torch.tensor(normalized_start_time).unsqueeze(0).to(device)
-    normalized_start_time = normalized_start_time.half()
+    normalized_start_time = normalized_start_time.to(dtype)
     
     normalized_duration = torch.tensor(normalized_duration).unsqueeze(0).to(device)
-    normalized_duration = normalized_duration.half()
+    normalized_duration = normalized_duration.to(dtype)
 
     return lrc_emb, normalized_start_time, end_frame, normalized_duration
 
 
-def load_checkpoint(model, ckpt_path, device, use_ema=True):
-    model = model.half()
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+
+def mmap_safetensors(path):
+    # tensors are views of a private file mapping, nothing is read until it is touched and
+    # processes mapping the same file share one page cached copy
+    with open(path, "rb") as f:
+        header_len = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_len))
+    header.pop("__metadata__", None)
+
+    nbytes = os.path.getsize(path)
+    storage = torch.UntypedStorage.from_file(path, shared=False, nbytes=nbytes)
+    data = torch.empty(0, dtype=torch.uint8).set_(storage, 0, (nbytes,))
+    data_start = 8 + header_len
+
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        tensor = data[data_start + start : data_start + end]
+        if (data_start + start) % dtype.itemsize:
+            # unaligned for its dtype, has to be copied
+            tensor = tensor.clone()
+        state_dict[name] = tensor.view(dtype).reshape(info["shape"])
+    return state_dict
+
+
+def load_safetensors(path):
+    # a single .safetensors file or the .safetensors.index.json of a sharded export
+    if not path.endswith(".index.json"):
+        return mmap_safetensors(path)
+    with open(path) as f:
+        weight_map = json.load(f)["weight_map"]
+    state_dict = {}
+    for shard in sorted(set(weight_map.values())):
+        state_dict.update(mmap_safetensors(os.path.join(os.path.dirname(path), shard)))
+    return state_dict
+
+
+def load_exported_checkpoint(build, ckpt_path, device, dtype=None):
+    from accelerate import init_empty_weights
+
+    state_dict = load_safetensors(ckpt_path)
+    if dtype is None:
+        dtype = next(v.dtype for v in state_dict.values() if v.is_floating_point())
+
+    # parameters are created on the meta device and replaced by the mapped tensors,
+    # non-persistent buffers (rotary frequencies) are still computed on cpu
+    with init_empty_weights(include_buffers=False):
+        model = build()
+    model.load_state_dict(state_dict, strict=False, assign=True)
+
+    missing = [name for name, p in model.named_parameters() if p.is_meta]
+    if missing:
+        raise ValueError(f"{ckpt_path} is missing weights: {missing[:5]}{' ...' if len(missing) > 5 else ''}")
+
+    stored = next(p.dtype for p in model.parameters() if p.is_floating_point())
+    if torch.device(device).type == "cpu" and stored != dtype:
+        print(f"{ckpt_path} stores {stored}, casting to {dtype} copies the weights instead of mapping them")
+    return model.to(device, dtype)
+
+
+def checkpoint_state_dict(checkpoint, use_ema=True):
+    # model weights of a training checkpoint, with the ema_model. prefix stripped for ema weights
+    if use_ema:
+        return {
+            k.replace("ema_model.", ""): v
+            for k, v in checkpoint["ema_model_state_dict"].items()
+            if k not in ["initted", "step"]
+        }
+    return checkpoint["model_state_dict"]
+
+
+def load_checkpoint(model, ckpt_path, device, use_ema=True, dtype=torch.float16):
+    model = model.to(dtype)
 
     ckpt_type = ckpt_path.split(".")[-1]
     if ckpt_type == "safetensors":
@@ -440,20 +998,11 @@ def load_checkpoint(model, ckpt_path, device, use_ema=True):
 
         checkpoint = load_file(ckpt_path)
     else:
-        checkpoint = torch.load(ckpt_path, weights_only=True)
+        # mapped, so the training layout is not fully read into memory before the half cast
+        checkpoint = torch.load(ckpt_path, weights_only=True, mmap=True)
 
-    if use_ema:
-        if ckpt_type == "safetensors":
-            checkpoint = {"ema_model_state_dict": checkpoint}
-        checkpoint["model_state_dict"] = {
-            k.replace("ema_model.", ""): v
-            for k, v in checkpoint["ema_model_state_dict"].items()
-            if k not in ["initted", "step"]
-        }
-        model.load_state_dict(checkpoint["model_state_dict"], strict=False)
-    else:
-        if ckpt_type == "safetensors":
-            checkpoint = {"model_state_dict": checkpoint}
-        model.load_state_dict(checkpoint["model_state_dict"], strict=False)
+    if ckpt_type == "safetensors":
+        checkpoint = {"ema_model_state_dict" if use_ema else "model_state_dict": checkpoint}
+    model.load_state_dict(checkpoint_state_dict(checkpoint, use_ema), strict=False)
 
     return model.to(device)
@@ -0,0 +1,268 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Pipelined batch inference, the dit samples one song while the vae decodes the previous one.
+
+    Jobs are read from a jsonl file with the same fields as infer/pool.py. Every job passes
+        prepare - lyrics tokens, style prompt and reference latent
+        sample  - dit sampling on --device
+        decode  - vae decoding on --vae-device, peak normalization and int16 conversion
+        write   - the audio file, format by the extension of output_path, on --write-workers threads
+    Each stage runs in its own thread and hands jobs on through queues of --queue-size, so a fast
+    stage cannot run ahead and pile up latents on the device. On one gpu the stages issue their
+    kernels on separate cuda streams and the vae fills the gaps left by the dit.
+
+    python3 infer/pipeline.py --jobs jobs.jsonl --max-frames 2048
+    python3 infer/pipeline.py --jobs jobs.jsonl --max-frames 6144 --device cuda:0 --vae-device cuda:1
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import queue
+import threading
+import time
+
+import torch
+
+from infer_utils import (
+    PrecisionPolicy,
+    get_negative_style_prompt,
+    latent_to_audio,
+    prepare_model,
+    prepare_request,
+    save_audio,
+)
+from model.sampler import ODESampler
+from vae_backend import VAE_BACKENDS, load_vae_backend
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a StagePipeline.
+    fn      - fn(item, value) -> value, gets the job and the output of the previous stage
+    workers - threads running fn concurrently, items may leave the stage out of order
+    device  - cuda device the stage computes on, every thread then gets its own stream
+    """
+
+    def __init__(self, name, fn, workers=1, device=None):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.device = torch.device(device) if device is not None else None
+
+
+class StagePipeline:
+    """
+    Runs items through a list of stages concurrently, connected by bounded queues. An item that fails
+    in a stage is passed on with its exception and skipped by the remaining stages.
+    run(items) yields (item, value, exception, seconds since the item entered) in completion order.
+    """
+
+    def __init__(self, stages, queue_size=2):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def _work(self, stage, inbox, outbox, remaining, lock):
+        stream = None
+        if stage.device is not None and stage.device.type == "cuda":
+            stream = torch.cuda.Stream(stage.device)
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                # for the other threads of this stage
+                inbox.put(_DONE)
+                break
+            job, value, error, s_t = item
+            if error is None:
+                try:
+                    with torch.inference_mode(), torch.cuda.stream(stream) if stream else contextlib.nullcontext():
+                        value = stage.fn(job, value)
+                        # the next stage reads the result from another stream
+                        if stream is not None:
+                            stream.synchronize()
+                except Exception as e:
+                    value, error = None, e
+            outbox.put((job, value, error, s_t))
+
+        with lock:
+            remaining[stage.name] -= 1
+            if remaining[stage.name] == 0:
+                outbox.put(_DONE)
+
+    def run(self, items):
+        queues = [queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        lock = threading.Lock()
+
+        def feed():
+            for item in items:
+                queues[0].put((item, item, None, time.time()))
+            queues[0].put(_DONE)
+
+        threads = [threading.Thread(target=feed, name="feed", daemon=True)]
+        for i, stage in enumerate(self.stages):
+            for j in range(stage.workers):
+                threads.append(
+                    threading.Thread(
+                        target=self._work,
+                        args=(stage, queues[i], queues[i + 1], remaining, lock),
+                        name=f"{stage.name}{j}",
+                        daemon=True,
+                    )
+                )
+        for thread in threads:
+            thread.start()
+
+        while (item := queues[-1].get()) is not _DONE:
+            job, value, error, s_t = item
+            yield job, value, error, time.time() - s_t
+        for thread in threads:
+            thread.join()
+
+
+def song_stages(
+    models,
+    max_frames,
+    device,
+    vae_device=None,
+    vae_micro_batch=1,
+    vae_workers=1,
+    write_workers=1,
+    overlap_decode=True,
+):
+    """
+    prepare, sample, decode and write stages for jobs of /generate fields plus output_path.
+    models         - (cfm, tokenizer, muq, vae, negative_style_prompt), the vae on vae_device
+    overlap_decode - False runs sampling and decoding in one stage, for cpu workers whose cores
+                     are all busy sampling anyway
+    """
+    cfm, tokenizer, muq, vae, negative_style_prompt = models
+    vae_device = vae_device or device
+
+    def prepare(job, _):
+        return prepare_request(
+            job,
+            max_frames,
+            tokenizer,
+            muq,
+            vae,
+            negative_style_prompt,
+            device,
+            dtype=negative_style_prompt.dtype,
+            vae_device=vae_device,
+        )
+
+    def sample(job, request):
+        return cfm.sample_batch(
+            [request],
+            steps=job.get("steps", 32),
+            cfg_strength=job.get("cfg_strength", 4.0),
+            sampler=ODESampler(job.get("solver", "euler")),
+        )[0]
+
+    def decode(job, latent):
+        return latent_to_audio(
+            latent.to(vae_device),
+            vae,
+            chunked=job.get("chunked", True),
+            micro_batch=vae_micro_batch,
+            num_workers=vae_workers,
+        )
+
+    def write(job, audio):
+        save_audio(job["output_path"], audio)
+        return job["output_path"]
+
+    if not overlap_decode:
+        return [
+            Stage("prepare", prepare, device=device),
+            Stage("sample", lambda job, request: decode(job, sample(job, request)), device=device),
+            Stage("write", write, workers=write_workers),
+        ]
+    return [
+        Stage("prepare", prepare, device=device),
+        Stage("sample", sample, device=device),
+        Stage("decode", decode, device=vae_device),
+        Stage("write", write, workers=write_workers),
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=str, required=True, help="jsonl file, one request per line")
+    parser.add_argument("--output-dir", type=str, default="infer/example/output", help="default output directory")
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=2048,
+        choices=[2048, 6144],
+        help="2048 serves 95 s songs, 6144 serves 96 to 285 s songs",
+    )
+    parser.add_argument("--device", type=str, default=None, help="device of the dit and muq, default cuda if available")
+    parser.add_argument("--vae-device", type=str, default=None, help="device of the vae, default --device")
+    parser.add_argument("--queue-size", type=int, default=2, help="jobs waiting between two stages")
+    parser.add_argument("--write-workers", type=int, default=2, help="threads writing output files")
+    parser.add_argument("--vae-backend", type=str, default="torchscript", choices=VAE_BACKENDS, help="see infer.py")
+    parser.add_argument("--vae-micro-batch", type=int, default=1, help="see infer.py")
+    parser.add_argument("--vae-workers", type=int, default=1, help="see infer.py")
+    parser.add_argument("--ckpt-path", type=str, default=None, help="cfm checkpoint, see infer.py")
+    parser.add_argument(
+        "--precision", type=str, default="auto", choices=["auto", "benchmark", "fp32", "bf16", "fp16"], help="see infer.py"
+    )
+    parser.add_argument("--attention-chunk-size", type=int, default=None, help="see infer.py")
+    parser.add_argument("--ff-chunk-size", type=int, default=None, help="see infer.py")
+    args = parser.parse_args()
+
+    with open(args.jobs, encoding="utf-8") as f:
+        jobs = [json.loads(line) for line in f if line.strip()]
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, job in enumerate(jobs):
+        job.setdefault("output_path", os.path.join(args.output_dir, f"output_{i}.wav"))
+
+    device = args.device or ("cuda" if torch.cuda.is_available() else "cpu")
+    vae_device = args.vae_device or device
+    precision = PrecisionPolicy.from_name(device, args.precision)
+    print(precision)
+    cfm, tokenizer, muq, vae = prepare_model(args.max_frames, device, ckpt_path=args.ckpt_path, dtype=precision.dtype)
+    vae = load_vae_backend(vae.to(vae_device), args.vae_backend, vae_device)
+    cfm.transformer.attention_chunk_size = args.attention_chunk_size
+    cfm.transformer.set_ff_chunk_size(args.ff_chunk_size)
+    models = (cfm, tokenizer, muq, vae, get_negative_style_prompt(device, dtype=precision.dtype))
+
+    stages = song_stages(
+        models,
+        args.max_frames,
+        device,
+        vae_device=vae_device,
+        vae_micro_batch=args.vae_micro_batch or None,
+        vae_workers=args.vae_workers,
+        write_workers=args.write_workers,
+    )
+
+    s_t = time.time()
+    failed = 0
+    for job, output_path, error, elapsed in StagePipeline(stages, queue_size=args.queue_size).run(jobs):
+        if error is None:
+            print(f"{output_path} done in {elapsed:.2f}s")
+        else:
+            failed += 1
+            print(f"{job['output_path']} failed: {error!r}")
+
+    total = time.time() - s_t
+    done = len(jobs) - failed
+    print(f"{done} songs in {total:.2f}s, {done / total * 3600:.1f} songs/hour")
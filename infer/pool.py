@@ -0,0 +1,176 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" CPU worker pool, for many-core hosts without a gpu.
+
+    Models are loaded once in the parent and the workers are forked from it, so all of them share
+    one copy-on-write copy of the weights (with an exported --ckpt-path the dit weights are also
+    backed by the page cache of the file). Every worker is pinned to its own slice of cores inside
+    one numa node and runs that many intra-op threads. Jobs are read from a jsonl file, one json
+    object per line with the /generate fields of infer/server.py plus
+        output_path - where the wav is written, default <output-dir>/output_<line>.wav
+
+    python3 infer/pool.py --jobs jobs.jsonl --threads-per-worker 16
+"""
+
+import argparse
+import glob
+import json
+import multiprocessing as mp
+import os
+import time
+
+import torch
+
+from infer_utils import PrecisionPolicy, get_negative_style_prompt, prepare_model
+from pipeline import StagePipeline, song_stages
+from vae_backend import VAE_BACKENDS, load_vae_backend
+
+
+def parse_cpulist(cpulist):
+    # "0-3,8,10-11" -> {0, 1, 2, 3, 8, 10, 11}
+    cpus = set()
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def numa_nodes():
+    # cpus of every numa node this process may run on, one node with all cpus when unknown
+    allowed = os.sched_getaffinity(0)
+    nodes = []
+    for path in sorted(glob.glob("/sys/devices/system/node/node[0-9]*/cpulist")):
+        with open(path) as f:
+            cpus = parse_cpulist(f.read()) & allowed
+        if cpus:
+            nodes.append(sorted(cpus))
+    return nodes or [sorted(allowed)]
+
+
+def plan_workers(nodes, threads_per_worker=16, num_workers=None):
+    # core slices that never cross a numa node, workers are spread round robin over the nodes
+    if num_workers is None:
+        num_workers = sum(max(len(cpus) // threads_per_worker, 1) for cpus in nodes)
+    per_node = [num_workers // len(nodes) + (i < num_workers % len(nodes)) for i in range(len(nodes))]
+
+    slices = []
+    for cpus, count in zip(nodes, per_node):
+        if count == 0:
+            continue
+        if count > len(cpus):
+            raise ValueError(f"{count} workers do not fit on a numa node with {len(cpus)} cpus")
+        size = len(cpus) // count
+        slices += [cpus[i * size : (i + 1) * size] for i in range(count)]
+    return slices
+
+
+def worker_main(rank, cpus, models, max_frames, device, jobs, results):
+    os.sched_setaffinity(0, cpus)
+    torch.set_num_threads(len(cpus))
+    print(f"worker {rank} on cpus {cpus[0]}-{cpus[-1]}", flush=True)
+
+    # the cores are busy sampling, only front-end work and file writes overlap it
+    stages = song_stages(models, max_frames, device, overlap_decode=False)
+    for job, _, error, elapsed in StagePipeline(stages, queue_size=1).run(iter(jobs.get, None)):
+        results.put((job["output_path"], rank, elapsed, None if error is None else repr(error)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--jobs", type=str, required=True, help="jsonl file, one request per line")
+    parser.add_argument("--output-dir", type=str, default="infer/example/output", help="default output directory")
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=2048,
+        choices=[2048, 6144],
+        help="2048 serves 95 s songs, 6144 serves 96 to 285 s songs",
+    )
+    parser.add_argument("--threads-per-worker", type=int, default=16, help="cores and intra-op threads per worker")
+    parser.add_argument(
+        "--num-workers", type=int, default=None, help="overrides the count derived from --threads-per-worker"
+    )
+    parser.add_argument("--ckpt-path", type=str, default=None, help="cfm checkpoint, see infer.py")
+    parser.add_argument(
+        "--precision",
+        type=str,
+        default="auto",
+        choices=["auto", "benchmark", "fp32", "bf16"],
+        help="auto: bf16 on cpus with native bf16 else fp32, benchmark: fastest safe dtype",
+    )
+    parser.add_argument(
+        "--attention-chunk-size", type=int, default=1024, help="see infer.py, 0 for unchunked attention"
+    )
+    parser.add_argument("--ff-chunk-size", type=int, default=1024, help="see infer.py, 0 for unchunked feed-forward")
+    parser.add_argument(
+        "--vae-backend",
+        type=str,
+        default="torchscript",
+        choices=VAE_BACKENDS,
+        help="see infer.py, onnx sessions are created per worker with its thread count",
+    )
+    args = parser.parse_args()
+
+    with open(args.jobs, encoding="utf-8") as f:
+        jobs = [json.loads(line) for line in f if line.strip()]
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, job in enumerate(jobs):
+        job.setdefault("output_path", os.path.join(args.output_dir, f"output_{i}.wav"))
+
+    slices = plan_workers(numa_nodes(), args.threads_per_worker, args.num_workers)
+
+    device = "cpu"
+    precision = PrecisionPolicy.from_name(device, args.precision)
+    print(precision)
+    cfm, tokenizer, muq, vae = prepare_model(args.max_frames, device, ckpt_path=args.ckpt_path, dtype=precision.dtype)
+    cfm.transformer.attention_chunk_size = args.attention_chunk_size or None
+    cfm.transformer.set_ff_chunk_size(args.ff_chunk_size or None)
+    vae = load_vae_backend(vae, args.vae_backend, device)
+    models = (cfm, tokenizer, muq, vae, get_negative_style_prompt(device, dtype=precision.dtype))
+
+    # forked workers inherit the loaded models without pickling or copying them
+    ctx = mp.get_context("fork")
+    job_queue, result_queue = ctx.Queue(), ctx.Queue()
+    for job in jobs:
+        job_queue.put(job)
+    for _ in slices:
+        job_queue.put(None)
+
+    s_t = time.time()
+    workers = [
+        ctx.Process(
+            target=worker_main, args=(rank, cpus, models, args.max_frames, device, job_queue, result_queue)
+        )
+        for rank, cpus in enumerate(slices)
+    ]
+    for worker in workers:
+        worker.start()
+
+    failed = 0
+    for _ in jobs:
+        output_path, rank, elapsed, error = result_queue.get()
+        if error is None:
+            print(f"{output_path} done by worker {rank} in {elapsed:.2f}s")
+        else:
+            failed += 1
+            print(f"{output_path} failed on worker {rank}: {error}")
+    for worker in workers:
+        worker.join()
+
+    total = time.time() - s_t
+    done = len(jobs) - failed
+    print(f"{done} songs in {total:.2f}s with {len(workers)} workers, {done / total * 3600:.1f} songs/hour")
@@ -0,0 +1,429 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Long running inference server, models are loaded once and requests are batched.
+
+    POST /generate  json body
+        lrc             - lyrics in lrc format, optional
+        ref_prompt      - text style prompt, or
+        ref_audio_path  - reference audio as style prompt, path on the server
+        audio_length    - 95 for a 2048 frame server, 96 to 285 for a 6144 frame server
+        edit, ref_song, edit_segments - song editing, same as infer.py
+        seed, steps, solver, cfg_strength - sampling, only the euler solver with continuous batching
+        chunked         - chunked vae decoding, default true
+        output          - "audio" returns audio/wav, "latent" returns the [1 n d] latent as .npy,
+                          "stream" sends loudness normalized audio/wav chunk by chunk while it decodes
+    GET /health
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import queue
+import threading
+import time
+import wave
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from infer_utils import (
+    PrecisionPolicy,
+    get_negative_style_prompt,
+    latent_to_audio,
+    prepare_model,
+    prepare_request,
+    stream_audio,
+)
+from model.compile import compile_dit, enable_compile_cache
+from model.offload import IdleOffload
+from model.sampler import ODESampler
+from model.scheduler import ContinuousBatchScheduler
+from vae_backend import VAE_BACKENDS, load_vae_backend
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+
+def wav_bytes(audio: torch.Tensor, sample_rate=44100):
+    # int16 [c n] -> wav file bytes
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as f:
+        f.setnchannels(audio.shape[0])
+        f.setsampwidth(2)
+        f.setframerate(sample_rate)
+        f.writeframes(audio.t().contiguous().numpy().tobytes())
+    return buffer.getvalue()
+
+
+def wav_stream_header(sample_rate=44100, channels=2):
+    # int16 wav header of unknown length, players read until the connection closes
+    block_align = channels * 2
+    return (
+        b"RIFF" + (0xFFFFFFFF).to_bytes(4, "little") + b"WAVEfmt "
+        + (16).to_bytes(4, "little") + (1).to_bytes(2, "little") + channels.to_bytes(2, "little")
+        + sample_rate.to_bytes(4, "little") + (sample_rate * block_align).to_bytes(4, "little")
+        + block_align.to_bytes(2, "little") + (16).to_bytes(2, "little")
+        + b"data" + (0xFFFFFFFF).to_bytes(4, "little")
+    )
+
+
+class InferenceServer:
+    def __init__(
+        self,
+        max_frames,
+        device,
+        max_batch_size=4,
+        batch_window=0.05,
+        front_workers=2,
+        continuous=False,
+        ckpt_path=None,
+        precision="auto",
+        compile_cache=None,
+        bucket=256,
+        attention_chunk_size=None,
+        ff_chunk_size=None,
+        offload=False,
+        vae_backend="torchscript",
+    ):
+        self.max_frames = max_frames
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.continuous = continuous
+        # with a compile cache the dit is compiled and durations are padded to buckets
+        self.bucket = bucket if compile_cache else None
+        if continuous and compile_cache:
+            raise ValueError("continuous batching mixes durations every step and cannot use the compiled dit")
+        if offload and compile_cache:
+            raise ValueError("streamed dit blocks cannot be compiled")
+        if offload and vae_backend != "torchscript":
+            raise ValueError("only the torchscript vae can be offloaded")
+
+        s_t = time.time()
+        self.precision = PrecisionPolicy.from_name(device, precision)
+        self.cfm, self.tokenizer, self.muq, self.vae = prepare_model(
+            max_frames, device, ckpt_path=ckpt_path, dtype=self.precision.dtype, offload=offload
+        )
+        # offloaded muq and vae are moved to the device while a request uses them
+        self.muq_context = IdleOffload(self.muq, device) if offload else contextlib.nullcontext()
+        self.vae_context = IdleOffload(self.vae, device) if offload else contextlib.nullcontext()
+        self.vae = load_vae_backend(self.vae, vae_backend, device)
+        self.cfm.transformer.attention_chunk_size = attention_chunk_size
+        self.cfm.transformer.set_ff_chunk_size(ff_chunk_size)
+        self.negative_style_prompt = get_negative_style_prompt(device, dtype=self.precision.dtype)
+        if compile_cache:
+            enable_compile_cache(compile_cache)
+            compile_dit(self.cfm.transformer)
+        print(f"models loaded in {time.time() - s_t:.2f} seconds")
+
+        # g2p / muq front-ends, dit sampling and vae decoding run in separate pools so they overlap
+        self.front_pool = ThreadPoolExecutor(front_workers, thread_name_prefix="front")
+        self.dit_pool = ThreadPoolExecutor(1, thread_name_prefix="dit")
+        self.vae_pool = ThreadPoolExecutor(1, thread_name_prefix="vae")
+
+        self.queue = None
+        self.backlog = deque()
+
+        # with continuous batching requests join the running dit batch between solver steps
+        self.scheduler = ContinuousBatchScheduler(self.cfm, max_batch_size=max_batch_size) if continuous else None
+        self.incoming = queue.Queue()
+
+    def _prepare_request(self, params):
+        if self.continuous and params.get("solver", "euler") != "euler":
+            raise ValueError("continuous batching only supports the euler solver")
+        # the vae only encodes the reference song of edit requests
+        vae_context = self.vae_context if params.get("edit") else contextlib.nullcontext()
+        with self.muq_context, vae_context:
+            return prepare_request(
+                params,
+                self.max_frames,
+                self.tokenizer,
+                self.muq,
+                self.vae,
+                self.negative_style_prompt,
+                self.device,
+                dtype=self.precision.dtype,
+            )
+
+    @staticmethod
+    def _batch_key(params):
+        # requests sharing a key can be sampled in one batch
+        return (params.get("steps", 32), params.get("solver", "euler"), params.get("cfg_strength", 4.0))
+
+    def _sample(self, requests, params):
+        steps, solver, cfg_strength = self._batch_key(params)
+        with torch.inference_mode():
+            return self.cfm.sample_batch(
+                requests, steps=steps, cfg_strength=cfg_strength, sampler=ODESampler(solver), bucket=self.bucket
+            )
+
+    def _decode(self, latent, chunked):
+        with torch.inference_mode(), self.vae_context:
+            return latent_to_audio(latent, self.vae, chunked=chunked)
+
+    async def generate(self, params):
+        loop = asyncio.get_running_loop()
+        request = await loop.run_in_executor(self.front_pool, self._prepare_request, params)
+
+        future = loop.create_future()
+        if self.continuous:
+            self.incoming.put((request, future, loop))
+        else:
+            await self.queue.put((request, params, future))
+        latent = await future
+
+        if params.get("output", "audio") == "latent":
+            buffer = io.BytesIO()
+            np.save(buffer, latent.to(torch.float32).cpu().numpy())
+            return "application/octet-stream", buffer.getvalue()
+
+        if params.get("output") == "stream":
+            return "audio/wav", self._stream(latent, params.get("chunked", True))
+
+        audio = await loop.run_in_executor(self.vae_pool, self._decode, latent, params.get("chunked", True))
+        return "audio/wav", wav_bytes(audio)
+
+    async def _stream(self, latent, chunked):
+        # decoded blocks are handed from the vae thread to the connection as they are finished
+        loop = asyncio.get_running_loop()
+        blocks = asyncio.Queue()
+
+        def decode():
+            try:
+                with torch.inference_mode(), self.vae_context:
+                    for block in stream_audio(latent, self.vae, chunked=chunked):
+                        loop.call_soon_threadsafe(blocks.put_nowait, block)
+                loop.call_soon_threadsafe(blocks.put_nowait, None)
+            except Exception as e:
+                loop.call_soon_threadsafe(blocks.put_nowait, e)
+
+        self.vae_pool.submit(decode)
+        yield wav_stream_header()
+        while (block := await blocks.get()) is not None:
+            if isinstance(block, Exception):
+                raise block
+            yield block.t().contiguous().numpy().tobytes()
+
+    async def _next_item(self, timeout=None):
+        if self.backlog:
+            return self.backlog.popleft()
+        if timeout is None:
+            return await self.queue.get()
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            first = await self._next_item()
+            batch, skipped = [first], []
+            key = self._batch_key(first[1])
+
+            # collect compatible requests for a short window
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = await self._next_item(timeout)
+                except asyncio.TimeoutError:
+                    break
+                if self._batch_key(item[1]) == key:
+                    batch.append(item)
+                else:
+                    skipped.append(item)
+            self.backlog.extend(skipped)
+
+            try:
+                latents = await loop.run_in_executor(
+                    self.dit_pool, self._sample, [request for request, _, _ in batch], first[1]
+                )
+                for (_, _, future), latent in zip(batch, latents):
+                    if not future.done():
+                        future.set_result(latent)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    @staticmethod
+    def _resolve(future, result=None, exception=None):
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def continuous_loop(self):
+        # runs in its own thread, one scheduler step per iteration
+        futures = {}
+        while True:
+            try:
+                # block only while idle
+                item = self.incoming.get(block=not self.scheduler.has_work())
+            except queue.Empty:
+                item = None
+            while item is not None:
+                request, future, loop = item
+                futures[id(future)] = (future, loop)
+                self.scheduler.add(id(future), request)
+                try:
+                    item = self.incoming.get_nowait()
+                except queue.Empty:
+                    item = None
+
+            try:
+                with torch.inference_mode():
+                    finished = self.scheduler.step()
+            except Exception as e:
+                # a failed step takes down every request in flight
+                for future, loop in futures.values():
+                    loop.call_soon_threadsafe(self._resolve, future, None, e)
+                futures.clear()
+                self.scheduler.waiting.clear()
+                self.scheduler.active.clear()
+                continue
+
+            for request_id, latent in finished:
+                future, loop = futures.pop(request_id)
+                loop.call_soon_threadsafe(self._resolve, future, latent)
+
+    async def handle(self, reader, writer):
+        status, content_type, payload = 200, "application/json", b""
+        try:
+            request_line = await reader.readline()
+            method, path, _ = request_line.decode("latin-1").split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, value = line.decode("latin-1").split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+            if method == "GET" and path == "/health":
+                payload = json.dumps({"status": "ok", "max_frames": self.max_frames}).encode()
+            elif method == "POST" and path == "/generate":
+                content_type, payload = await self.generate(json.loads(body or b"{}"))
+            else:
+                status, payload = 404, json.dumps({"error": f"{method} {path} not found"}).encode()
+        except (ValueError, KeyError) as e:
+            status, content_type, payload = 400, "application/json", json.dumps({"error": str(e)}).encode()
+        except Exception as e:
+            status, content_type, payload = 500, "application/json", json.dumps({"error": repr(e)}).encode()
+
+        if isinstance(payload, bytes):
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                f"Content-Length: {len(payload)}\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+                + payload
+            )
+        else:
+            # streamed response, an error after the headers can only end the connection early
+            writer.write(
+                f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\n"
+                f"Content-Type: {content_type}\r\n"
+                "Transfer-Encoding: chunked\r\n"
+                "Connection: close\r\n\r\n".encode("latin-1")
+            )
+            try:
+                async for part in payload:
+                    writer.write(f"{len(part):x}\r\n".encode("latin-1") + part + b"\r\n")
+                    await writer.drain()
+                writer.write(b"0\r\n\r\n")
+            except Exception as e:
+                print(f"stream aborted: {e!r}")
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host, port):
+        self.queue = asyncio.Queue()
+        if self.continuous:
+            threading.Thread(target=self.continuous_loop, name="dit", daemon=True).start()
+        batcher = asyncio.create_task(self.batch_loop())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"serving on http://{host}:{port}")
+        async with server:
+            try:
+                await server.serve_forever()
+            finally:
+                batcher.cancel()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+    parser.add_argument("--port", type=int, default=8000, help="port to listen on")
+    parser.add_argument(
+        "--max-frames",
+        type=int,
+        default=2048,
+        choices=[2048, 6144],
+        help="2048 serves 95 s songs, 6144 serves 96 to 285 s songs",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=4, help="maximum number of requests per dit batch")
+    parser.add_argument(
+        "--batch-window-ms", type=float, default=50, help="how long to wait for compatible requests to batch"
+    )
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="admit requests into the running dit batch between solver steps, euler solver only",
+    )
+    parser.add_argument("--ckpt-path", type=str, default=None, help="cfm checkpoint, see infer.py")
+    parser.add_argument(
+        "--precision", type=str, default="auto", choices=["auto", "benchmark", "fp32", "bf16", "fp16"], help="see infer.py"
+    )
+    parser.add_argument("--compile", action="store_true", help="torch.compile the dit, see infer.py")
+    parser.add_argument("--bucket", type=int, default=256, help="duration bucket in frames used with --compile")
+    parser.add_argument("--compile-cache", type=str, default="./pretrained/compile_cache", help="see infer.py")
+    parser.add_argument("--attention-chunk-size", type=int, default=None, help="see infer.py")
+    parser.add_argument("--ff-chunk-size", type=int, default=None, help="see infer.py")
+    parser.add_argument("--offload", action="store_true", help="see infer.py")
+    parser.add_argument("--vae-backend", type=str, default="torchscript", choices=VAE_BACKENDS, help="see infer.py")
+    args = parser.parse_args()
+
+    print("Current working directory:", os.getcwd())
+
+    device = "cpu"
+    if torch.cuda.is_available():
+        device = "cuda"
+    elif torch.mps.is_available():
+        device = "mps"
+
+    server = InferenceServer(
+        args.max_frames,
+        device,
+        max_batch_size=args.max_batch_size,
+        batch_window=args.batch_window_ms / 1000,
+        continuous=args.continuous_batching,
+        ckpt_path=args.ckpt_path,
+        precision=args.precision,
+        compile_cache=args.compile_cache if args.compile else None,
+        bucket=args.bucket,
+        attention_chunk_size=args.attention_chunk_size,
+        ff_chunk_size=args.ff_chunk_size,
+        offload=args.offload,
+        vae_backend=args.vae_backend,
+    )
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,156 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Runtimes for the vae, all of them expose decode_export / encode_export like the torchscript module.
+
+        torchscript - the downloaded module as is
+        frozen      - torch.jit.freeze + optimize_for_inference, weights folded into the graph
+        onnx        - onnx export run by onnxruntime with all graph optimizations
+
+        vae = load_vae_backend(vae, "onnx", device)
+        audio = decode_audio(latent, vae, chunked=True)
+
+    Frozen and onnx runtimes are bound to the device they were built for and cannot be offloaded.
+"""
+
+import os
+
+import torch
+from torch import nn
+
+VAE_BACKENDS = ("torchscript", "frozen", "onnx")
+
+DOWNSAMPLING_RATIO = 2048
+LATENT_DIM = 64
+VAE_METHODS = ("decode_export", "encode_export")
+
+
+def freeze_vae(vae):
+    # weights become constants of the graph, conv / norm folding and on cpu mkldnn prepacking
+    frozen = torch.jit.freeze(vae.eval(), preserved_attrs=list(VAE_METHODS))
+    return torch.jit.optimize_for_inference(frozen, other_methods=list(VAE_METHODS))
+
+
+class _Decode(nn.Module):
+    # the onnx exporter only exports forward
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, x):
+        return self.vae.decode_export(x)
+
+
+class _Encode(nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, x):
+        return self.vae.encode_export(x)
+
+
+def export_vae_onnx(vae, output_dir, opset_version=17):
+    # fp32 decoder and encoder graphs with dynamic batch and length, exported on cpu
+    os.makedirs(output_dir, exist_ok=True)
+    vae = vae.to("cpu").eval()
+    examples = {
+        "decode_export": (_Decode, torch.randn(1, LATENT_DIM, 8)),
+        "encode_export": (_Encode, torch.randn(1, 2, 8 * DOWNSAMPLING_RATIO)),
+    }
+    paths = {}
+    for method, (wrapper, example) in examples.items():
+        paths[method] = os.path.join(output_dir, f"{method.split('_')[0]}.onnx")
+        with torch.no_grad():
+            torch.onnx.export(
+                # scripted, a trace cannot enter methods other than forward of the torchscript vae
+                torch.jit.script(wrapper(vae).eval()),
+                (example,),
+                paths[method],
+                input_names=["input"],
+                output_names=["output"],
+                dynamic_axes={"input": {0: "batch", 2: "length"}, "output": {0: "batch", 2: "out_length"}},
+                opset_version=opset_version,
+                dynamo=False,
+            )
+    return paths
+
+
+class OnnxVAE:
+    """
+    onnxruntime sessions of an exported vae. Inputs and outputs are bound to torch tensors on the
+    device, so neither direction goes through numpy. Sessions are created on first use, which lets
+    forked cpu workers (infer/pool.py) build their own thread pools sized by torch.get_num_threads().
+    """
+
+    def __init__(self, paths, device):
+        self.paths = paths
+        self.device = torch.device(device)
+        self.sessions = {}
+
+    def _session(self, method):
+        if method not in self.sessions:
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            if self.device.type == "cuda":
+                providers = [("CUDAExecutionProvider", {"device_id": self.device.index or 0}), "CPUExecutionProvider"]
+            else:
+                options.intra_op_num_threads = torch.get_num_threads()
+                providers = ["CPUExecutionProvider"]
+            self.sessions[method] = ort.InferenceSession(self.paths[method], options, providers=providers)
+        return self.sessions[method]
+
+    def _run(self, method, x, out_shape):
+        import numpy as np
+
+        session = self._session(method)
+        x = x.to(self.device, torch.float32).contiguous()
+        out = torch.empty(out_shape, device=self.device, dtype=torch.float32)
+        device_type, device_id = self.device.type, self.device.index or 0
+        binding = session.io_binding()
+        binding.bind_input("input", device_type, device_id, np.float32, tuple(x.shape), x.data_ptr())
+        binding.bind_output("output", device_type, device_id, np.float32, tuple(out.shape), out.data_ptr())
+        if device_type == "cuda":
+            # onnxruntime runs on its own stream
+            torch.cuda.current_stream(self.device).synchronize()
+        session.run_with_iobinding(binding)
+        binding.synchronize_outputs()
+        return out
+
+    def decode_export(self, latents):
+        # [b 64 t] -> [b 2 t * 2048]
+        b, _, t = latents.shape
+        return self._run("decode_export", latents, (b, 2, t * DOWNSAMPLING_RATIO))
+
+    def encode_export(self, audio):
+        # [b 2 n] -> [b 128 n / 2048], mean and scale
+        b, _, n = audio.shape
+        return self._run("encode_export", audio, (b, 2 * LATENT_DIM, n // DOWNSAMPLING_RATIO))
+
+
+def load_vae_backend(vae, backend, device, onnx_dir="./pretrained/vae_onnx"):
+    # vae - the torchscript module of load_vae, backends other than torchscript are built on device
+    if backend == "torchscript":
+        return vae
+    if backend == "frozen":
+        return freeze_vae(vae.to(device))
+    if backend == "onnx":
+        paths = {method: os.path.join(onnx_dir, f"{method.split('_')[0]}.onnx") for method in VAE_METHODS}
+        if not all(os.path.exists(path) for path in paths.values()):
+            # exported once, later runs load the cached graphs
+            paths = export_vae_onnx(vae, onnx_dir)
+        return OnnxVAE(paths, device)
+    raise ValueError(f"unknown vae backend {backend}, expected one of {VAE_BACKENDS}")
@@ -1,6 +1,14 @@
 from model.cfm import CFM
 from model.dit import DiT
-from model.trainer import Trainer
+
+
+def __getattr__(name):
+    # the trainer pulls in accelerate, wandb and the dataset code, only import it for training
+    if name == "Trainer":
+        from model.trainer import Trainer
+
+        return Trainer
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 __all__ = ["CFM"]
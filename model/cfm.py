@@ -29,9 +29,10 @@ import torch
 import torch.nn.functional as F
 from torch.nn.utils.rnn import pad_sequence
 
-from torchdiffeq import odeint
-
+from model.dit import FeatureCache
+from model.sampler import GuidanceSchedule, ODESampler
 from model.utils import (
+    default,
     exists,
     list_str_to_idx,
     list_str_to_tensor,
@@ -137,12 +138,20 @@ class CFM(nn.Module):
         start_time=None,
         latent_pred_segments=None,
         song_duration=None,
-        batch_infer_num=1
+        batch_infer_num=1,
+        batch_cfg=True,
+        sampler: ODESampler | None = None,
+        guidance: GuidanceSchedule | None = None,
+        feature_cache: FeatureCache | None = None,
+        bucket: int | None = None,
     ):
         self.eval()
 
-        if next(self.parameters()).dtype == torch.float16:
-            cond = cond.half()
+        # inputs from infer_utils are half, follow the model dtype instead
+        dtype = next(self.parameters()).dtype
+        cond = cond.to(dtype)
+        style_prompt, negative_style_prompt = style_prompt.to(dtype), negative_style_prompt.to(dtype)
+        start_time, song_duration = start_time.to(dtype), song_duration.to(dtype)
 
         # raw wave
         if cond.shape[1] > duration:
@@ -185,11 +194,6 @@ class CFM(nn.Module):
         if duplicate_test:
             test_cond = F.pad(cond, (0, 0, cond_seq_len, max_duration - 2 * cond_seq_len), value=0.0)
 
-        if batch > 1:
-            mask = lens_to_mask(duration)
-        else:  # save memory and speed up, as single inference need no mask currently
-            mask = None
-
         # test for no ref audio
         if no_ref_audio:
             cond = torch.zeros_like(cond)
@@ -203,21 +207,6 @@ class CFM(nn.Module):
         fixed_span_mask = fixed_span_mask.repeat(batch_infer_num, 1, 1)
         song_duration = song_duration.repeat(batch_infer_num)
 
-        def fn(t, x):
-            # predict flow
-            pred = self.transformer(
-                x=x, cond=step_cond, text=text, time=t, drop_audio_cond=False, drop_text=False, drop_prompt=False,
-                style_prompt=style_prompt, start_time=start_time, duration=song_duration
-            )
-            if cfg_strength < 1e-5:
-                return pred
-
-            null_pred = self.transformer(
-                x=x, cond=step_cond, text=text, time=t, drop_audio_cond=True, drop_text=True, drop_prompt=False,
-                style_prompt=negative_style_prompt, start_time=start_time, duration=song_duration
-            )
-            return pred + (pred - null_pred) * cfg_strength
-
         # noise input
         # to make sure batch inference result is same with different batch size, and for sure single inference
         # still some difference maybe due to convolutional layers
@@ -226,7 +215,8 @@ class CFM(nn.Module):
             if exists(seed):
                 torch.manual_seed(seed)
             y0.append(torch.randn(dur, self.num_channels, device=self.device, dtype=step_cond.dtype))
-        y0 = pad_sequence(y0, padding_value=0, batch_first=True)
+        # noise is drawn in the model dtype as before, the ode state and time grid are kept in fp32
+        y0 = pad_sequence(y0, padding_value=0, batch_first=True).float()
 
         t_start = 0
 
@@ -236,13 +226,16 @@ class CFM(nn.Module):
             y0 = (1 - t_start) * y0 + t_start * test_cond
             steps = int(steps * (1 - t_start))
         
-        t = torch.linspace(t_start, 1, steps, device=self.device, dtype=step_cond.dtype)
+        t = torch.linspace(t_start, 1, steps, device=self.device, dtype=torch.float32)
         if sway_sampling_coef is not None:
             t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
 
-        trajectory = odeint(fn, y0, t, **self.odeint_kwargs)
+        sampled, trajectory = self._integrate(
+            y0, t, step_cond, text, style_prompt, negative_style_prompt, start_time, song_duration,
+            cfg_strength=cfg_strength, batch_cfg=batch_cfg, sampler=sampler, guidance=guidance, feature_cache=feature_cache,
+            bucket=bucket
+        )
 
-        sampled = trajectory[-1]
         out = sampled
         out = torch.where(fixed_span_mask, out, cond)
 
@@ -253,6 +246,181 @@ class CFM(nn.Module):
         out = torch.chunk(out, batch_infer_num, dim=0)
         return out, trajectory
 
+    def _integrate(
+        self,
+        y0: float["b n d"],  # noqa: F722
+        t: float["s"],  # noqa: F821
+        step_cond: float["b n d"],  # noqa: F722
+        text: int["b n"],  # noqa: F722
+        style_prompt,
+        negative_style_prompt,
+        start_time,
+        song_duration,
+        *,
+        lens: int["b"] | None = None,  # noqa: F821
+        cfg_strength=4.0,
+        batch_cfg=True,
+        sampler: ODESampler | None = None,
+        guidance: GuidanceSchedule | None = None,
+        feature_cache: FeatureCache | None = None,
+        bucket: int | None = None,
+    ):
+        # pad the sequence to a multiple of bucket frames so compiled graphs are reused across durations,
+        # the padding is masked out like in a right padded batch
+        seq_len = step_cond.shape[1]
+        if exists(bucket) and seq_len % bucket:
+            pad = bucket - seq_len % bucket
+            lens = default(lens, torch.full((y0.shape[0],), seq_len, device=y0.device, dtype=torch.long))
+            y0 = F.pad(y0, (0, 0, 0, pad))
+            step_cond = F.pad(step_cond, (0, 0, 0, pad))
+            text = F.pad(text, (0, pad))
+            sampled, trajectory = self._integrate(
+                y0, t, step_cond, text, style_prompt, negative_style_prompt, start_time, song_duration,
+                lens=lens, cfg_strength=cfg_strength, batch_cfg=batch_cfg, sampler=sampler, guidance=guidance,
+                feature_cache=feature_cache
+            )
+            return sampled[:, :seq_len], trajectory[..., :seq_len, :] if exists(trajectory) else None
+
+        # guidance window and unconditional prediction reuse, default guides every step
+        guidance = default(guidance, GuidanceSchedule())
+        use_cfg = cfg_strength >= 1e-5
+        null_cache = dict(pred=None, guided_calls=0)
+
+        # text, start time / duration embeddings, rope and attention mask stay fixed across ode steps
+        if batch_cfg and use_cfg:
+            # stack cond and null branches along batch, one dit forward per guided step
+            cfg_batch = step_cond.shape[0]
+            cfg_lens = torch.cat((lens, lens), dim=0) if exists(lens) else None
+            cfg_drop = torch.arange(2 * cfg_batch, device=y0.device) >= cfg_batch
+            cfg_cond = torch.cat((step_cond, step_cond), dim=0)
+            cfg_style_prompt = torch.cat((style_prompt, negative_style_prompt), dim=0)
+            cfg_prepared = self.transformer.forward_timestep_invariant(
+                torch.cat((text, text), dim=0), seq_len, cfg_drop,
+                torch.cat((start_time, start_time), dim=0), torch.cat((song_duration, song_duration), dim=0), lens=cfg_lens
+            )
+            prepared = cfg_prepared.chunk(2)[0]
+        else:
+            prepared = self.transformer.forward_timestep_invariant(text, seq_len, False, start_time, song_duration, lens=lens)
+            if use_cfg:
+                null_prepared = self.transformer.forward_timestep_invariant(text, seq_len, True, start_time, song_duration, lens=lens)
+
+        def fn(t, x):
+            guided = use_cfg and guidance.in_interval(t.item())
+            # the dit runs in its own dtype, the solver integrates in fp32
+            t, x = t.to(step_cond.dtype), x.to(step_cond.dtype)
+            run_null = guided and (null_cache["pred"] is None or guidance.recompute(null_cache["guided_calls"]))
+            if guided:
+                null_cache["guided_calls"] += 1
+
+            if run_null and batch_cfg:
+                pred, null_pred = self.transformer(
+                    x=torch.cat((x, x), dim=0), cond=cfg_cond, text=None, time=t,
+                    drop_audio_cond=cfg_drop, drop_text=cfg_drop, drop_prompt=False,
+                    style_prompt=cfg_style_prompt, prepared=cfg_prepared, feature_cache=feature_cache
+                ).chunk(2, dim=0)
+            else:
+                # predict flow
+                pred = self.transformer(
+                    x=x, cond=step_cond, text=text, time=t, drop_audio_cond=False, drop_text=False, drop_prompt=False,
+                    style_prompt=style_prompt, prepared=prepared, feature_cache=feature_cache
+                )
+                if run_null:
+                    null_pred = self.transformer(
+                        x=x, cond=step_cond, text=text, time=t, drop_audio_cond=True, drop_text=True, drop_prompt=False,
+                        style_prompt=negative_style_prompt, prepared=null_prepared, feature_cache=feature_cache
+                    )
+
+            if run_null:
+                null_cache["pred"] = null_pred
+            if not guided:
+                return pred.float()
+            return (pred + (pred - null_cache["pred"]) * cfg_strength).float()
+
+        # pass a sampler to pick the solver, read back nfe or record the trajectory
+        if sampler is None:
+            sampler = ODESampler(**self.odeint_kwargs)
+        sampled = sampler(fn, y0, t)
+        return sampled, sampler.trajectory
+
+    @torch.no_grad()
+    def sample_batch(
+        self,
+        requests: list[dict],
+        *,
+        steps=32,
+        cfg_strength=4.0,
+        sway_sampling_coef=None,
+        batch_cfg=True,
+        sampler: ODESampler | None = None,
+        guidance: GuidanceSchedule | None = None,
+        feature_cache: FeatureCache | None = None,
+        bucket: int | None = None,
+    ):
+        """
+        Samples independent requests in one batch. Every request is a dict with
+        cond                    - [1 n d] reference latent, zeros when not editing
+        text                    - [1 nt] lyric tokens from get_lrc_token
+        duration                - number of frames to generate
+        style_prompt            - [1 512]
+        negative_style_prompt   - [1 512]
+        start_time              - [1]
+        song_duration           - [1]
+        latent_pred_segments    - [(start_frame, end_frame), ...] to generate, the rest is kept from cond
+        seed                    - optional
+        Requests are right padded to the longest duration (rounded up to a multiple of bucket frames
+        when given) and the padding is masked out of attention.
+        Returns a list with one [1 duration d] latent per request.
+        """
+        self.eval()
+
+        device, dtype = self.device, next(self.parameters()).dtype
+
+        durations, conds, step_conds, texts, fixed_span_masks, y0 = [], [], [], [], [], []
+        for request in requests:
+            duration = request["duration"]
+            cond = request["cond"][0, :duration].to(device, dtype)
+            cond = F.pad(cond, (0, 0, 0, duration - cond.shape[0]))
+            latent_pred_segments = torch.tensor(request["latent_pred_segments"]).to(device)
+            fixed_span_mask = custom_mask_from_start_end_indices(duration, latent_pred_segments, device=device, max_seq_len=duration)
+            fixed_span_mask = fixed_span_mask.reshape(duration, 1)
+            text = request["text"][0, :duration].to(device)
+            text = F.pad(text, (0, duration - text.shape[0]))
+
+            # same noise as a single request sampled with the same seed
+            if exists(request.get("seed")):
+                torch.manual_seed(request["seed"])
+
+            durations.append(duration)
+            conds.append(cond)
+            step_conds.append(torch.where(fixed_span_mask, torch.zeros_like(cond), cond))
+            texts.append(text)
+            fixed_span_masks.append(fixed_span_mask)
+            y0.append(torch.randn(duration, self.num_channels, device=device, dtype=dtype).float())
+
+        lens = torch.tensor(durations, device=device, dtype=torch.long)
+        cond = pad_sequence(conds, padding_value=0, batch_first=True)
+        step_cond = pad_sequence(step_conds, padding_value=0, batch_first=True)
+        text = pad_sequence(texts, padding_value=0, batch_first=True)
+        fixed_span_mask = pad_sequence(fixed_span_masks, padding_value=False, batch_first=True)
+        y0 = pad_sequence(y0, padding_value=0, batch_first=True)
+        style_prompt = torch.cat([request["style_prompt"] for request in requests], dim=0).to(device, dtype)
+        negative_style_prompt = torch.cat([request["negative_style_prompt"] for request in requests], dim=0).to(device, dtype)
+        start_time = torch.cat([request["start_time"] for request in requests], dim=0).to(device, dtype)
+        song_duration = torch.cat([request["song_duration"] for request in requests], dim=0).to(device, dtype)
+
+        t = torch.linspace(0, 1, steps, device=device, dtype=torch.float32)
+        if sway_sampling_coef is not None:
+            t = t + sway_sampling_coef * (torch.cos(torch.pi / 2 * t) - 1 + t)
+
+        sampled, _ = self._integrate(
+            y0, t, step_cond, text, style_prompt, negative_style_prompt, start_time, song_duration,
+            lens=lens, cfg_strength=cfg_strength, batch_cfg=batch_cfg, sampler=sampler, guidance=guidance,
+            feature_cache=feature_cache, bucket=bucket
+        )
+
+        out = torch.where(fixed_span_mask, sampled, cond)
+        return [out[i : i + 1, :duration] for i, duration in enumerate(durations)]
+
     def forward(
         self,
         inp: float["b n d"] | float["b nw"],  # mel or raw wave  # noqa: F722
@@ -0,0 +1,82 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" torch.compile of DiT.forward with a persistent on-disk cache.
+
+    Compiled graphs are specialized on shapes, so sampling should pad the duration to a multiple of
+    a bucket (CFM.sample / sample_batch bucket=...) to get one graph per bucket and batch size.
+
+        enable_compile_cache("./pretrained/compile_cache")
+        compile_dit(cfm.transformer)
+        ... warm up every bucket once (infer/compile_dit.py) ...
+        save_compile_cache("./pretrained/compile_cache")
+
+    Inductor kernels and fx graphs are kept in the cache directory, with torch >= 2.7 the cache is
+    also saved as one portable artifact file that a fresh worker loads before its first call.
+"""
+
+from __future__ import annotations
+
+import os
+
+import torch
+
+from model.dit import DiT
+
+
+ARTIFACT_FILE = "compile_artifacts.bin"
+
+
+def bucket_length(seq_len, bucket):
+    return -(-seq_len // bucket) * bucket
+
+
+def enable_compile_cache(cache_dir):
+    # must run before the first compilation of the process
+    os.makedirs(cache_dir, exist_ok=True)
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(cache_dir))
+    torch._inductor.config.fx_graph_cache = True
+    if hasattr(torch._inductor.config, "autotune_local_cache"):
+        torch._inductor.config.autotune_local_cache = True
+
+    artifact_path = os.path.join(cache_dir, ARTIFACT_FILE)
+    if hasattr(torch.compiler, "load_cache_artifacts") and os.path.exists(artifact_path):
+        with open(artifact_path, "rb") as f:
+            torch.compiler.load_cache_artifacts(f.read())
+
+
+def save_compile_cache(cache_dir):
+    if not hasattr(torch.compiler, "save_cache_artifacts"):
+        return None
+    artifacts = torch.compiler.save_cache_artifacts()
+    if artifacts is None:
+        return None
+    artifact_path = os.path.join(cache_dir, ARTIFACT_FILE)
+    with open(artifact_path, "wb") as f:
+        f.write(artifacts[0])
+    return artifact_path
+
+
+def compile_dit(dit: DiT, mode=None, max_graphs=64):
+    """
+    Compiles DiT.forward in place for static shapes. Switches to dense attention, packed varlen
+    batches have data dependent shapes. max_graphs bounds the recompiles (buckets x batch sizes)
+    before dynamo falls back to eager.
+    """
+    dit.attention_mode = "dense"
+    for name in ("recompile_limit", "cache_size_limit"):
+        if hasattr(torch._dynamo.config, name):
+            setattr(torch._dynamo.config, name, max(getattr(torch._dynamo.config, name), max_graphs))
+    dit.compile(dynamic=False, mode=mode)
+    return dit
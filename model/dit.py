@@ -21,12 +21,12 @@
 
 from __future__ import annotations
 
+from collections import OrderedDict
+
 import torch
 from torch import nn
 import torch
-
-from transformers.models.llama.modeling_llama import LlamaDecoderLayer, LlamaRotaryEmbedding
-from transformers.models.llama import LlamaConfig
+import torch.nn.functional as F
 
 from model.modules import (
     TimestepEmbedding,
@@ -36,7 +36,11 @@ from model.modules import (
     precompute_freqs_cis,
     get_pos_embed_indices,
     _prepare_decoder_attention_mask,
+    LlamaBlock,
+    FusedLlamaMLP,
+    RotaryEmbedding,
 )
+from model.utils import lens_to_mask
 
 # Text embedding
 class TextEmbedding(nn.Module):
@@ -54,10 +58,12 @@ class TextEmbedding(nn.Module):
         else:
             self.extra_modeling = False
 
-    def forward(self, text: int["b nt"], seq_len, drop_text=False):  # noqa: F722
+    def forward(self, text: int["b nt"], seq_len, drop_text: bool | bool["b"] = False):  # noqa: F722 F821
         batch, text_len = text.shape[0], text.shape[1]
 
-        if drop_text:  # cfg for text
+        if torch.is_tensor(drop_text):  # per-sample cfg for text
+            text = text.masked_fill(drop_text[:, None], 0)
+        elif drop_text:  # cfg for text
             text = torch.zeros_like(text)
 
         text = self.text_embed(text)  # b n -> b n d
@@ -83,16 +89,123 @@ class InputEmbedding(nn.Module):
         self.proj = nn.Linear(mel_dim * 2 + text_dim + cond_dim * 2, out_dim)
         self.conv_pos_embed = ConvPositionEmbedding(dim=out_dim)
 
-    def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], style_emb, time_emb, drop_audio_cond=False):  # noqa: F722
-        if drop_audio_cond:  # cfg for cond audio
+    def forward(self, x: float["b n d"], cond: float["b n d"], text_embed: float["b n d"], style_emb, time_emb, drop_audio_cond: bool | bool["b"] = False, mask: bool["b n"] | None = None):  # noqa: F722 F821
+        if torch.is_tensor(drop_audio_cond):  # per-sample cfg for cond audio
+            cond = cond.masked_fill(drop_audio_cond[:, None, None], 0.0)
+        elif drop_audio_cond:  # cfg for cond audio
             cond = torch.zeros_like(cond)
         style_emb = style_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
         time_emb = time_emb.unsqueeze(1).repeat(1, x.shape[1], 1)
         x = self.proj(torch.cat((x, cond, text_embed, style_emb, time_emb), dim=-1))
-        x = self.conv_pos_embed(x) + x
+        x = self.conv_pos_embed(x, mask=mask) + x
         return x
 
 
+# everything DiT.forward needs that depends neither on time step nor on noised input,
+# built once per request by DiT.forward_timestep_invariant and reused across ode steps
+class PreparedCondition:
+    def __init__(self, time_cond, text_embed, text_residuals, rotary_embed, attention_mask, mask=None, varlen=False):
+        self.time_cond = time_cond  # start time + duration embedding, b d
+        self.text_embed = text_embed  # b n d
+        self.text_residuals = text_residuals  # one per text fusion layer, b n d
+        self.rotary_embed = rotary_embed  # (cos, sin) for positions 0..n-1, 1 n d
+        self.attention_mask = attention_mask  # additive b 1 n n, None for mask-free attention
+        self.mask = mask  # b n, None when no sample in the batch is padded
+
+        # padded batch with varlen attention, the transformer blocks run on the packed valid frames only
+        self.varlen = varlen
+        self.packed = varlen and mask is not None
+        if self.packed:
+            batch, seq_len = mask.shape
+            lens = mask.sum(dim=1)
+            self.indices = mask.flatten().nonzero().squeeze(-1)
+            cu_seqlens = F.pad(lens.cumsum(0), (1, 0)).to(torch.int32)
+            self.attention_kwargs = dict(
+                cu_seqlens=cu_seqlens, max_seqlen=lens.max().item(), seq_bounds=cu_seqlens.tolist()
+            )
+            pos_ids = torch.arange(seq_len, device=mask.device).repeat(batch)[self.indices]
+            cos, sin = rotary_embed
+            self.block_rotary_embed = (cos[:, pos_ids], sin[:, pos_ids])
+            self.block_text_residuals = [self.pack(residual) for residual in text_residuals]
+        else:
+            self.attention_kwargs = {}
+            self.block_rotary_embed = rotary_embed
+            self.block_text_residuals = text_residuals
+
+    def pack(self, x: float["b n d"]) -> float["1 nv d"]:  # noqa: F722
+        return x.flatten(0, 1)[self.indices].unsqueeze(0)
+
+    def unpack(self, x: float["1 nv d"]) -> float["b n d"]:  # noqa: F722
+        batch, seq_len = self.mask.shape
+        out = x.new_zeros(batch * seq_len, x.shape[-1])
+        out[self.indices] = x[0]
+        return out.view(batch, seq_len, -1)
+
+    def chunk(self, chunks):
+        # split along batch, rotary embedding is shared by all samples
+        def split(x):
+            return x.chunk(chunks, dim=0) if x is not None else [None] * chunks
+
+        time_conds = split(self.time_cond)
+        text_embeds = split(self.text_embed)
+        text_residuals = list(zip(*[split(residual) for residual in self.text_residuals]))
+        attention_masks = split(self.attention_mask)
+        masks = split(self.mask)
+        return [
+            PreparedCondition(
+                time_conds[i], text_embeds[i], list(text_residuals[i]), self.rotary_embed, attention_masks[i],
+                mask=masks[i] if masks[i] is not None and not masks[i].all() else None, varlen=self.varlen,
+            )
+            for i in range(chunks)
+        ]
+
+
+# step-to-step cache of the transformer blocks residual (teacache / deepcache style),
+# one instance per request, blocks from start_layer on are skipped while the accumulated
+# relative change of the block input since the last computed step stays below threshold
+class FeatureCache:
+    def __init__(self, threshold=0.05, start_layer=0):
+        assert start_layer >= 0
+        self.threshold = threshold
+        self.start_layer = start_layer
+        self.hits = 0
+        self.misses = 0
+        self._states = {}
+        self._state = None
+
+    def reset(self):
+        self.hits = 0
+        self.misses = 0
+        self._states = {}
+        self._state = None
+
+    def check(self, x: float["b n d"], key=None):  # noqa: F722
+        # separate state per branch, e.g. conditional, unconditional and fused guidance calls
+        state = self._states.setdefault((key, tuple(x.shape)), dict(prev_input=None, residual=None, accumulated=0.0))
+        self._state = state
+
+        reuse = False
+        if state["residual"] is not None:
+            prev_input = state["prev_input"]
+            state["accumulated"] += ((x - prev_input).abs().mean() / prev_input.abs().mean()).item()
+            reuse = state["accumulated"] < self.threshold
+        state["prev_input"] = x
+
+        if reuse:
+            self.hits += 1
+        else:
+            self.misses += 1
+            state["accumulated"] = 0.0
+        return reuse
+
+    @property
+    def residual(self):
+        return self._state["residual"]
+
+    def store(self, residual: float["b n d"]):  # noqa: F722
+        self._state["residual"] = residual
+
+
 # Transformer backbone using Llama blocks
 class DiT(nn.Module):
     def __init__(
@@ -109,12 +222,26 @@ class DiT(nn.Module):
         text_dim=None,
         conv_layers=0,
         long_skip_connection=False,
-        max_frames=2048
+        max_frames=2048,
+        attention_mode="varlen",
+        attention_chunk_size=None,
+        attention_window=None,
+        global_layers=(),
+        attention_block_size=128,
+        global_blocks=(),
+        ff_chunk_size=None,
     ):
         super().__init__()
         
         self.max_frames = max_frames
 
+        # "varlen": mask-free attention, padded batches are packed and attend per sample
+        # "dense": additive b 1 n n mask built from the padding mask
+        assert attention_mode in ("varlen", "dense")
+        self.attention_mode = attention_mode
+        # query / key chunk of the exact online softmax attention in inference, None for plain sdpa
+        self.attention_chunk_size = attention_chunk_size
+
         cond_dim = 512
         self.time_embed = TimestepEmbedding(cond_dim)
         self.start_time_embed = TimestepEmbedding(cond_dim)
@@ -127,12 +254,9 @@ class DiT(nn.Module):
         self.dim = dim
         self.depth = depth
 
-        llama_config = LlamaConfig(hidden_size=dim, intermediate_size=dim * ff_mult, hidden_act='silu', max_position_embeddings=self.max_frames)
-        llama_config._attn_implementation = 'sdpa'
-        self.transformer_blocks = nn.ModuleList(
-            [LlamaDecoderLayer(llama_config, layer_idx=i) for i in range(depth)]
-        )
-        self.rotary_emb = LlamaRotaryEmbedding(config=llama_config)
+        # 32 heads regardless of heads, the blocks were built from a default LlamaConfig
+        self.transformer_blocks = nn.ModuleList([LlamaBlock(dim, dim * ff_mult, heads=32) for _ in range(depth)])
+        self.rotary_emb = RotaryEmbedding(dim // 32, max_pos=self.max_frames)
         self.long_skip_connection = nn.Linear(dim * 2, dim, bias=False) if long_skip_connection else None
 
         self.text_fusion_linears = nn.ModuleList(
@@ -150,15 +274,163 @@ class DiT(nn.Module):
         self.norm_out = AdaLayerNormZero_Final(dim, cond_dim)  # final modulation
         self.proj_out = nn.Linear(dim, mel_dim)
 
-    def forward_timestep_invariant(self, text, seq_len, drop_text, start_time):
+        # lru of null text embeddings, each holds depth // 2 + 1 [1 n dim] tensors, so only a few lengths
+        self.null_text_cache_size = 4
+        self._null_text_cache = OrderedDict()
+
+        self.set_attention_window(attention_window, global_layers, attention_block_size, global_blocks)
+        self.set_ff_chunk_size(ff_chunk_size)
+
+    def set_ff_chunk_size(self, chunk_size=None):
+        # sequence chunks of the block mlps and the text conv-next blocks, None for unchunked
+        for module in self.modules():
+            if isinstance(module, (FusedLlamaMLP, ConvNeXtV2Block)):
+                module.chunk_size = chunk_size
+
+    def set_attention_window(self, window=None, global_layers=(), block_size=128, global_blocks=()):
+        """
+        Local block sparse attention, frames attend to at least window frames on either side.
+        window        - frames, one value for all layers or a list with one value (or None) per layer
+        global_layers - indices of layers that keep full attention, quadratic in the duration again
+        global_blocks - block indices (negative from the end) attending to and attended by all frames
+                        in every local layer, song level context at linear cost
+        None or 0 restores full attention everywhere. Works with any checkpoint, though the
+        released ones are trained with full attention and should be fine-tuned for local windows.
+        """
+        windows = window if isinstance(window, (list, tuple)) else [window] * self.depth
+        assert len(windows) == self.depth
+        global_blocks = tuple(global_blocks)
+        self.attention_windows = [
+            (w, block_size, global_blocks) if w and i not in global_layers else None for i, w in enumerate(windows)
+        ]
+
+    def train(self, mode=True):
+        # cached null text embeddings are only valid for frozen weights
+        if mode:
+            self.clear_cache()
+        return super().train(mode)
+
+    def clear_cache(self):
+        # call after loading new weights into a model in eval mode
+        self._null_text_cache = OrderedDict()
+
+    def _embed_text(self, text, seq_len):
+        text_embed = self.text_embed(text, seq_len)
+        text_residuals = [layer(text_embed) for layer in self.text_fusion_linears]
+        return text_embed, text_residuals
+
+    def _null_text(self, seq_len, device):
+        # embedding of an all-filler lyric only depends on seq_len, so keep it around across requests
+        # bounded, without a duration bucket every song length is its own entry
+        key = (seq_len, device, self.norm_out.linear.weight.dtype)
+        if key in self._null_text_cache:
+            self._null_text_cache.move_to_end(key)
+            return self._null_text_cache[key]
+        null_text = torch.zeros((1, seq_len), dtype=torch.long, device=device)
+        self._null_text_cache[key] = self._embed_text(null_text, seq_len)
+        while len(self._null_text_cache) > self.null_text_cache_size:
+            self._null_text_cache.popitem(last=False)
+        return self._null_text_cache[key]
+
+    def _text_condition(self, text, seq_len, drop_text):
+        batch, device = text.shape[0], text.device
+        use_null_cache = not self.training and not torch.is_grad_enabled()
+
+        if not use_null_cache:
+            text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
+            text_residuals = [layer(text_embed) for layer in self.text_fusion_linears]
+        elif torch.is_tensor(drop_text) and not drop_text.all():
+            null_embed, null_residuals = self._null_text(seq_len, device)
+            keep = ~drop_text
+            cond_embed, cond_residuals = self._embed_text(text[keep], seq_len)
+            text_embed = null_embed.repeat(batch, 1, 1)
+            text_embed[keep] = cond_embed
+            text_residuals = []
+            for null_residual, cond_residual in zip(null_residuals, cond_residuals):
+                text_residual = null_residual.repeat(batch, 1, 1)
+                text_residual[keep] = cond_residual
+                text_residuals.append(text_residual)
+        elif torch.is_tensor(drop_text) or drop_text:
+            null_embed, null_residuals = self._null_text(seq_len, device)
+            text_embed = null_embed.expand(batch, -1, -1)
+            text_residuals = [residual.expand(batch, -1, -1) for residual in null_residuals]
+        else:
+            text_embed, text_residuals = self._embed_text(text, seq_len)
+
+        return text_embed, text_residuals
+
+    def forward_timestep_invariant(self, text, seq_len, drop_text, start_time, duration=None, lens=None):
+        batch, device = text.shape[0], text.device
+
         s_t = self.start_time_embed(start_time)
-        text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
-        text_residuals = []
-        for layer in self.text_fusion_linears:
-            text_residual = layer(text_embed)
-            text_residuals.append(text_residual)
-        return s_t, text_embed, text_residuals
+        d_t = self.duration_time_embed(duration) if self.max_frames == 6144 else torch.zeros_like(s_t)
+
+        if lens is not None and (lens < seq_len).any():
+            # right padded batch of different lengths, embed every sample on its own length
+            # as the text convolutions and grn would otherwise see the padding
+            mask = lens_to_mask(lens, length=seq_len)
+            text_embed, text_residuals = [], []
+            for i, sample_len in enumerate(lens.tolist()):
+                sample_drop = drop_text[i : i + 1] if torch.is_tensor(drop_text) else drop_text
+                sample_embed, sample_residuals = self._text_condition(text[i : i + 1, :sample_len], sample_len, sample_drop)
+                text_embed.append(F.pad(sample_embed, (0, 0, 0, seq_len - sample_len)))
+                text_residuals.append([F.pad(residual, (0, 0, 0, seq_len - sample_len)) for residual in sample_residuals])
+            text_embed = torch.cat(text_embed, dim=0)
+            text_residuals = [torch.cat(residuals, dim=0) for residuals in zip(*text_residuals)]
+        else:
+            mask = None
+            text_embed, text_residuals = self._text_condition(text, seq_len, drop_text)
+
+        pos_ids = torch.arange(seq_len, device=device).unsqueeze(0)
+        rotary_embed = self.rotary_emb(text_embed, pos_ids)
+
+        attention_mask = self._attention_mask(mask, batch, seq_len, text_embed)
 
+        return PreparedCondition(
+            s_t + d_t, text_embed, text_residuals, rotary_embed, attention_mask, mask=mask,
+            varlen=self.attention_mode == "varlen",
+        )
+
+    def _attention_mask(self, mask, batch, seq_len, ref):
+        if self.attention_mode != "dense":
+            # no padding needs no mask, padded batches are packed in forward
+            return None
+
+        # key padding mask, padded frames are never attended to
+        attention_mask = mask if mask is not None else torch.ones(
+            (batch, seq_len),
+            dtype=torch.bool,
+            device=ref.device,
+        )
+        return _prepare_decoder_attention_mask(
+            attention_mask,
+            (batch, seq_len),
+            ref,
+        )
+
+    def collate_prepared(self, prepared_list: list[PreparedCondition]):
+        # merge unpadded prepared conditions of possibly different lengths into one right padded batch
+        lens = [prepared.text_embed.shape[1] for prepared in prepared_list]
+        seq_len = max(lens)
+
+        def pad_cat(xs):
+            return torch.cat([F.pad(x, (0, 0, 0, seq_len - x.shape[1])) for x in xs], dim=0)
+
+        time_cond = torch.cat([prepared.time_cond for prepared in prepared_list], dim=0)
+        text_embed = pad_cat([prepared.text_embed for prepared in prepared_list])
+        text_residuals = [pad_cat(residuals) for residuals in zip(*[prepared.text_residuals for prepared in prepared_list])]
+
+        batch, device = text_embed.shape[0], text_embed.device
+        lens = torch.tensor(lens, device=device)
+        mask = lens_to_mask(lens, length=seq_len) if (lens < seq_len).any() else None
+        pos_ids = torch.arange(seq_len, device=device).unsqueeze(0)
+        rotary_embed = self.rotary_emb(text_embed, pos_ids)
+        attention_mask = self._attention_mask(mask, batch, seq_len, text_embed)
+
+        return PreparedCondition(
+            time_cond, text_embed, text_residuals, rotary_embed, attention_mask, mask=mask,
+            varlen=self.attention_mode == "varlen",
+        )
 
     def forward(
         self,
@@ -166,54 +438,64 @@ class DiT(nn.Module):
         cond: float["b n d"],  # masked cond audio  # noqa: F722
         text: int["b nt"],  # text  # noqa: F722
         time: float["b"] | float[""],  # time step  # noqa: F821 F722
-        drop_audio_cond,  # cfg for cond audio
-        drop_text,  # cfg for text
-        drop_prompt=False,
+        drop_audio_cond,  # cfg for cond audio, bool or per-sample bool["b"]
+        drop_text,  # cfg for text, bool or per-sample bool["b"]
+        drop_prompt=False,  # bool or per-sample bool["b"]
         style_prompt=None, # [b d t]
         start_time=None,
-        duration=None
+        duration=None,
+        prepared: PreparedCondition | None = None,  # from forward_timestep_invariant, overrides text/start_time/duration/drop_text
+        feature_cache: FeatureCache | None = None,
     ):
 
         batch, seq_len = x.shape[0], x.shape[1]
         if time.ndim == 0:
             time = time.repeat(batch)
 
+        if prepared is None:
+            prepared = self.forward_timestep_invariant(text, seq_len, drop_text, start_time, duration)
+
         # t: conditioning time, c: context (text + masked cond audio), x: noised input audio
         t = self.time_embed(time)
-        s_t = self.start_time_embed(start_time)
-        d_t = self.duration_time_embed(duration) if self.max_frames == 6144 else torch.zeros_like(s_t)
-        c = t + s_t + d_t
-        text_embed = self.text_embed(text, seq_len, drop_text=drop_text)
+        c = t + prepared.time_cond
+        text_embed = prepared.text_embed
 
-        if drop_prompt:
+        if torch.is_tensor(drop_prompt):
+            style_prompt = style_prompt.masked_fill(drop_prompt[:, None], 0.0)
+        elif drop_prompt:
             style_prompt = torch.zeros_like(style_prompt)
         
         style_embed = style_prompt # [b, 512]
 
-        x = self.input_embed(x, cond, text_embed, style_embed, c, drop_audio_cond=drop_audio_cond)
+        x = self.input_embed(x, cond, text_embed, style_embed, c, drop_audio_cond=drop_audio_cond, mask=prepared.mask)
 
         if self.long_skip_connection is not None:
             residual = x
 
-        pos_ids = torch.arange(x.shape[1], device=x.device)
-        pos_ids = pos_ids.unsqueeze(0).repeat(x.shape[0], 1)
-        rotary_embed = self.rotary_emb(x, pos_ids)
-        
-        attention_mask = torch.ones(
-            (batch, seq_len),
-            dtype=torch.bool,
-            device=x.device,
-        )
-        attention_mask = _prepare_decoder_attention_mask(
-            attention_mask,
-            (batch, seq_len),
-            x,
-        )
+        if prepared.packed:
+            x = prepared.pack(x)
 
+        if feature_cache is not None:
+            assert 0 <= feature_cache.start_layer < self.depth, f"feature cache start_layer must be in [0, {self.depth})"
+        reuse = feature_cache is not None and feature_cache.check(x, key=id(prepared))
         for i, block in enumerate(self.transformer_blocks):
-            x, *_ = block(x, attention_mask=attention_mask, position_embeddings=rotary_embed)
+            if feature_cache is not None and i == feature_cache.start_layer:
+                if reuse:
+                    x = x + feature_cache.residual
+                    break
+                cache_input = x
+            x = block(
+                x, attention_mask=prepared.attention_mask, position_embeddings=prepared.block_rotary_embed,
+                attention_chunk_size=self.attention_chunk_size, attention_window=self.attention_windows[i],
+                **prepared.attention_kwargs
+            )
             if i < self.depth // 2:
-                x = x + self.text_fusion_linears[i](text_embed)
+                x = x + prepared.block_text_residuals[i]
+        if feature_cache is not None and not reuse:
+            feature_cache.store(x - cache_input)
+
+        if prepared.packed:
+            x = prepared.unpack(x)
 
         if self.long_skip_connection is not None:
             x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
@@ -28,6 +28,10 @@ import torchaudio
 
 from x_transformers.x_transformers import apply_rotary_pos_emb
 
+try:
+    from flash_attn import flash_attn_varlen_func
+except ImportError:
+    flash_attn_varlen_func = None
 
 
 class FiLMLayer(nn.Module):
@@ -132,7 +136,14 @@ class ConvPositionEmbedding(nn.Module):
             x = x.masked_fill(~mask, 0.0)
 
         x = x.permute(0, 2, 1)
-        x = self.conv1d(x)
+        if mask is None:
+            x = self.conv1d(x)
+        else:
+            # re-mask after every conv so padding never leaks into the valid frames
+            for layer in self.conv1d:
+                x = layer(x)
+                if isinstance(layer, nn.Mish):
+                    x = x.masked_fill(~mask.transpose(1, 2), 0.0)
         out = x.permute(0, 2, 1)
 
         if mask is not None:
@@ -173,6 +184,14 @@ def get_pos_embed_indices(start, length, max_pos, scale=1.0):
 # Global Response Normalization layer (Instance Normalization ?)
 
 
+def chunked_feed_forward(fn, x, chunk_size=None, dim=1):
+    # runs a position-wise fn over chunks of the sequence, its intermediate activations
+    # only exist for chunk_size frames at a time
+    if chunk_size is None or x.shape[dim] <= chunk_size:
+        return fn(x)
+    return torch.cat([fn(chunk) for chunk in x.split(chunk_size, dim=dim)], dim=dim)
+
+
 class GRN(nn.Module):
     def __init__(self, dim):
         super().__init__()
@@ -206,8 +225,12 @@ class ConvNeXtV2Block(nn.Module):
         self.act = nn.GELU()
         self.grn = GRN(intermediate_dim)
         self.pwconv2 = nn.Linear(intermediate_dim, dim)
+        # frames per chunk of the pointwise convs, None for the whole sequence at once
+        self.chunk_size = None
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.chunk_size is not None and x.shape[1] > self.chunk_size:
+            return self._chunked_forward(x)
         residual = x
         x = x.transpose(1, 2)  # b n d -> b d n
         x = self.dwconv(x)
@@ -219,6 +242,25 @@ class ConvNeXtV2Block(nn.Module):
         x = self.pwconv2(x)
         return residual + x
 
+    def _chunked_forward(self, x):
+        # grn normalizes by the l2 norm over the whole sequence, so the intermediate activations are
+        # computed twice per chunk, once to accumulate that norm and once for the output
+        h = self.norm(self.dwconv(x.transpose(1, 2)).transpose(1, 2))
+        chunks = h.split(self.chunk_size, dim=1)
+
+        sq_sum = 0
+        for chunk in chunks:
+            sq_sum = sq_sum + self.act(self.pwconv1(chunk)).float().pow(2).sum(dim=1, keepdim=True)
+        Gx = sq_sum.sqrt()
+        Nx = (Gx / (Gx.mean(dim=-1, keepdim=True) + 1e-6)).to(x.dtype)
+
+        out = []
+        for chunk in chunks:
+            y = self.act(self.pwconv1(chunk))
+            y = self.grn.gamma * (y * Nx) + self.grn.beta + y
+            out.append(self.pwconv2(y))
+        return x + torch.cat(out, dim=1)
+
 
 # AdaLayerNormZero
 # return with modulated x for attn input, and params for later mlp modulation
@@ -619,6 +661,302 @@ class TimestepEmbedding(nn.Module):
         return time
 
 
+def chunked_attention(query, key, value, attn_mask=None, scale=None, chunk_size=1024):
+    """
+    Exact softmax attention computed over chunk_size x chunk_size tiles of the scores with a running
+    max and sum (online softmax), peak memory is b h chunk_size^2 instead of b h n^2.
+    attn_mask - additive float or boolean (True attends) mask broadcastable to b h n n
+    """
+    scale = query.shape[-1] ** -0.5 if scale is None else scale
+    out = torch.empty_like(query)
+    for q_start in range(0, query.shape[2], chunk_size):
+        q = query[:, :, q_start : q_start + chunk_size] * scale
+        acc = torch.zeros(q.shape, device=q.device, dtype=torch.float32)
+        row_max = torch.full((*q.shape[:-1], 1), float("-inf"), device=q.device, dtype=torch.float32)
+        row_sum = torch.zeros_like(row_max)
+        for k_start in range(0, key.shape[2], chunk_size):
+            k = key[:, :, k_start : k_start + chunk_size]
+            scores = torch.matmul(q, k.transpose(-1, -2)).float()
+            if attn_mask is not None:
+                mask = attn_mask[..., q_start : q_start + chunk_size, k_start : k_start + chunk_size]
+                if mask.dtype == torch.bool:
+                    scores = scores.masked_fill(~mask, float("-inf"))
+                else:
+                    scores = scores + mask
+            new_max = torch.maximum(row_max, scores.amax(dim=-1, keepdim=True))
+            # rows without any visible key so far keep a zero reference instead of -inf - -inf
+            new_max = new_max.masked_fill(new_max == float("-inf"), 0.0)
+            probs = torch.exp(scores - new_max)
+            correction = torch.exp(row_max - new_max)
+            row_sum = row_sum * correction + probs.sum(dim=-1, keepdim=True)
+            v = value[:, :, k_start : k_start + chunk_size]
+            acc = acc * correction + torch.matmul(probs.to(v.dtype), v).float()
+            row_max = new_max
+        out[:, :, q_start : q_start + chunk_size] = (acc / row_sum).to(out.dtype)
+    return out
+
+
+def local_attention(
+    query, key, value, window, block_size=128, attn_mask=None, scale=None, dropout=0.0, global_blocks=()
+):
+    """
+    Block sparse sliding window attention, the queries of every block of block_size frames attend to
+    the keys of their own block and of the ceil(window / block_size) blocks on either side.
+    global_blocks - block indices (negative from the end) whose keys every query attends to and whose
+                    queries attend to all keys, they carry song level context across the windows
+    Cost and memory grow linearly with the sequence length, by (2 * halo + (1 + 2 * globals) * block)
+    keys per query.
+    attn_mask - additive or boolean (True attends) key padding mask b 1 n n, only its first row is used
+    """
+    batch, heads, seq_len, dim = query.shape
+    scale = dim ** -0.5 if scale is None else scale
+    halo = -(-window // block_size) * block_size
+    num_blocks = -(-seq_len // block_size)
+    pad = num_blocks * block_size - seq_len
+    span = 2 * halo + block_size
+    global_blocks = sorted({g % num_blocks for g in global_blocks if -num_blocks <= g < num_blocks})
+
+    # large negative instead of -inf, fully padded query rows must not turn into nan in backward
+    neg = torch.finfo(torch.float32).min
+    if attn_mask is None:
+        key_bias = torch.zeros(batch, 1, seq_len, device=query.device)
+    elif attn_mask.dtype == torch.bool:
+        key_bias = torch.zeros(attn_mask[:, :, 0].shape, device=query.device).masked_fill(~attn_mask[:, :, 0], neg)
+    else:
+        key_bias = attn_mask[:, :, 0].float().clamp(min=neg)
+    local_bias = F.pad(key_bias, (halo, halo + pad), value=neg).unfold(-1, span, block_size)  # b 1 nb span
+
+    q = F.pad(query * scale, (0, 0, 0, pad)).view(batch, heads, num_blocks, block_size, dim)
+    k = F.pad(key, (0, 0, halo, halo + pad)).unfold(2, span, block_size)  # b h nb d span
+    v = F.pad(value, (0, 0, halo, halo + pad)).unfold(2, span, block_size)
+
+    scores = torch.matmul(q, k).float() + local_bias.unsqueeze(-2)  # b h nb block span
+    if not global_blocks:
+        probs = F.dropout(scores.softmax(dim=-1), p=dropout, training=dropout > 0)
+        x = torch.matmul(probs.to(v.dtype), v.transpose(-1, -2))
+        return x.reshape(batch, heads, num_blocks * block_size, dim)[:, :, :seq_len]
+
+    # keys of the global blocks for every query block, unless already inside its window
+    index = torch.cat([torch.arange(g * block_size, (g + 1) * block_size) for g in global_blocks]).to(query.device)
+    padded_bias = F.pad(key_bias, (0, pad), value=neg)
+    global_k = F.pad(key, (0, 0, 0, pad))[:, :, index]  # b h g*block d
+    global_v = F.pad(value, (0, 0, 0, pad))[:, :, index]
+    blocks = torch.arange(num_blocks, device=query.device)
+    in_window = (blocks[:, None] - index[None] // block_size).abs() <= halo // block_size  # nb g*block
+    global_bias = padded_bias[:, :, index].unsqueeze(-2).masked_fill(in_window, neg)  # b 1 nb g*block
+    global_scores = torch.matmul(q, global_k.transpose(-1, -2).unsqueeze(2)).float() + global_bias.unsqueeze(-2)
+
+    probs = torch.cat([scores, global_scores], dim=-1).softmax(dim=-1)
+    probs = F.dropout(probs, p=dropout, training=dropout > 0).to(v.dtype)
+    x = torch.matmul(probs[..., :span], v.transpose(-1, -2)) + torch.matmul(probs[..., span:], global_v.unsqueeze(2))
+    x = x.reshape(batch, heads, num_blocks * block_size, dim)
+
+    # queries of the global blocks attend everywhere
+    global_q = q.reshape(batch, heads, num_blocks * block_size, dim)[:, :, index]
+    full_scores = torch.matmul(global_q, key.transpose(-1, -2)).float() + key_bias.unsqueeze(-2)  # b h g*block n
+    full_probs = F.dropout(full_scores.softmax(dim=-1), p=dropout, training=dropout > 0)
+    x = x.index_copy(2, index, torch.matmul(full_probs.to(value.dtype), value))
+    return x[:, :, :seq_len]
+
+
+# attention function of the llama blocks of DiT (FusedLlamaAttention below)
+# attention_mask None     - no padding in the batch, plain sdpa without mask so the fused kernels apply
+# cu_seqlens              - packed batch [1 h total d] of samples with different lengths,
+#                           each sample only attends within [cu_seqlens[i], cu_seqlens[i + 1])
+# attention_chunk_size    - exact chunked_attention for longer sequences in inference, bounds the
+#                           memory of the scores where sdpa falls back to the math path (cpu)
+# attention_window        - local_attention of this layer, (window, block_size, global_blocks)
+
+
+def dit_attention_forward(
+    module,
+    query,
+    key,
+    value,
+    attention_mask,
+    dropout=0.0,
+    scaling=None,
+    cu_seqlens=None,
+    max_seqlen=None,
+    seq_bounds=None,
+    attention_chunk_size=None,
+    attention_window=None,
+    **kwargs,
+):
+    def attend(q, k, v, mask=None):
+        if attention_window is not None and q.shape[2] > attention_window[1]:
+            window, block_size, global_blocks = attention_window
+            return local_attention(
+                q, k, v, window, block_size, mask, scale=scaling, dropout=dropout, global_blocks=global_blocks
+            )
+        if attention_chunk_size is not None and not module.training and q.shape[2] > attention_chunk_size:
+            return chunked_attention(q, k, v, mask, scale=scaling, chunk_size=attention_chunk_size)
+        return F.scaled_dot_product_attention(q, k, v, attn_mask=mask, dropout_p=dropout, scale=scaling, is_causal=False)
+
+    if cu_seqlens is None:
+        x = attend(query, key, value, attention_mask)
+        return x.transpose(1, 2).contiguous(), None
+
+    if attention_window is None and flash_attn_varlen_func is not None and query.is_cuda and query.dtype in (torch.float16, torch.bfloat16):
+        q, k, v = (t[0].transpose(0, 1) for t in (query, key, value))  # 1 h total d -> total h d
+        x = flash_attn_varlen_func(
+            q, k, v, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen, dropout_p=dropout, softmax_scale=scaling
+        )
+        return x.unsqueeze(0), None
+
+    xs = []
+    for start, end in zip(seq_bounds[:-1], seq_bounds[1:]):
+        xs.append(attend(query[:, :, start:end], key[:, :, start:end], value[:, :, start:end]))
+    x = torch.cat(xs, dim=2)
+    return x.transpose(1, 2).contiguous(), None
+
+
+# llama decoder layer of the DiT backbone, same math and checkpoint layout as transformers'
+# LlamaDecoderLayer, with fused q/k/v and gate/up projections
+
+
+class RMSNorm(nn.Module):
+    def __init__(self, dim, eps=1e-6):
+        super().__init__()
+        self.weight = nn.Parameter(torch.ones(dim))
+        self.eps = eps
+
+    def forward(self, x):
+        dtype = x.dtype
+        x = x.float()
+        x = x * torch.rsqrt(x.pow(2).mean(-1, keepdim=True) + self.eps)
+        return self.weight * x.to(dtype)
+
+
+class RotaryEmbedding(nn.Module):
+    # cos / sin table for positions 0..max_pos-1, extended on demand for longer sequences
+    def __init__(self, dim, max_pos=2048, theta=10000.0):
+        super().__init__()
+        self.dim = dim
+        self.theta = theta
+        self._set_table(max_pos)
+
+    def _set_table(self, max_pos, device=None):
+        inv_freq = 1.0 / (self.theta ** (torch.arange(0, self.dim, 2, device=device, dtype=torch.int64).float() / self.dim))
+        freqs = torch.outer(torch.arange(max_pos, device=device).float(), inv_freq)
+        emb = torch.cat((freqs, freqs), dim=-1)
+        self.register_buffer("cos", emb.cos(), persistent=False)
+        self.register_buffer("sin", emb.sin(), persistent=False)
+
+    def forward(self, x, position_ids):
+        # position_ids b n -> (cos, sin) b n d in the dtype of x
+        if position_ids.shape[-1] > 0 and position_ids.max().item() >= self.cos.shape[0]:
+            dtype = self.cos.dtype
+            self._set_table(position_ids.max().item() + 1, device=self.cos.device)
+            self.cos, self.sin = self.cos.to(dtype), self.sin.to(dtype)
+        return self.cos[position_ids].to(x.dtype), self.sin[position_ids].to(x.dtype)
+
+
+def rotate_half(x):
+    x1, x2 = x.chunk(2, dim=-1)
+    return torch.cat((-x2, x1), dim=-1)
+
+
+class FusedLlamaAttention(nn.Module):
+    def __init__(self, dim, heads=32):
+        super().__init__()
+        self.heads = heads
+        self.head_dim = dim // heads
+        self.scaling = self.head_dim ** -0.5
+        self.qkv_proj = nn.Linear(dim, 3 * heads * self.head_dim, bias=False)
+        self.o_proj = nn.Linear(heads * self.head_dim, dim, bias=False)
+
+    def forward(self, x, position_embeddings, attention_mask=None, **kwargs):
+        batch, seq_len = x.shape[:2]
+        qkv = self.qkv_proj(x).view(batch, seq_len, 3, self.heads, self.head_dim)
+        query, key, value = (t.transpose(1, 2) for t in qkv.unbind(dim=2))  # b h n d
+
+        cos, sin = (t.unsqueeze(1) for t in position_embeddings)
+        query = query * cos + rotate_half(query) * sin
+        key = key * cos + rotate_half(key) * sin
+
+        x, _ = dit_attention_forward(self, query, key, value, attention_mask, scaling=self.scaling, **kwargs)
+        return self.o_proj(x.reshape(batch, seq_len, -1))
+
+
+class FusedLlamaMLP(nn.Module):
+    def __init__(self, dim, intermediate_dim):
+        super().__init__()
+        self.intermediate_dim = intermediate_dim
+        self.gate_up_proj = nn.Linear(dim, 2 * intermediate_dim, bias=False)
+        self.down_proj = nn.Linear(intermediate_dim, dim, bias=False)
+        # frames per chunk of the sequence, the 4x wider activations then only exist for a chunk at a time
+        self.chunk_size = None
+
+    def _forward(self, x):
+        gate, up = self.gate_up_proj(x).chunk(2, dim=-1)
+        return self.down_proj(F.silu(gate) * up)
+
+    def forward(self, x):
+        return chunked_feed_forward(self._forward, x, self.chunk_size)
+
+
+def _fuse_weights(state_dict, prefix, names, fused):
+    keys = [prefix + name + ".weight" for name in names]
+    if all(key in state_dict for key in keys):
+        state_dict[prefix + fused + ".weight"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+
+def _split_weights(state_dict, prefix, names, fused):
+    weight = state_dict.pop(prefix + fused + ".weight")
+    for name, part in zip(names, weight.chunk(len(names), dim=0)):
+        state_dict[prefix + name + ".weight"] = part
+
+
+def fuse_llama_state_dict(state_dict):
+    # LlamaDecoderLayer layout -> the fused qkv_proj / gate_up_proj layout, which LlamaBlock loads
+    # as is, so exported checkpoints (infer/export_checkpoint.py) stay mapped from disk
+    for key in [k for k in state_dict if k.endswith("self_attn.q_proj.weight")]:
+        _fuse_weights(state_dict, key[: -len("q_proj.weight")], LlamaBlock.QKV, "qkv_proj")
+    for key in [k for k in state_dict if k.endswith("mlp.gate_proj.weight")]:
+        _fuse_weights(state_dict, key[: -len("gate_proj.weight")], LlamaBlock.GATE_UP, "gate_up_proj")
+    return state_dict
+
+
+class LlamaBlock(nn.Module):
+    """
+    Pre-norm llama decoder layer, 32 heads like the transformers LlamaConfig default the released
+    checkpoints were trained with. State dicts keep the LlamaDecoderLayer layout, separate
+    q/k/v and gate/up weights of training checkpoints are fused (copied) on load and split again
+    on save, already fused weights are loaded without a copy.
+    """
+
+    QKV = ("q_proj", "k_proj", "v_proj")
+    GATE_UP = ("gate_proj", "up_proj")
+
+    def __init__(self, dim, intermediate_dim, heads=32, eps=1e-6):
+        super().__init__()
+        self.input_layernorm = RMSNorm(dim, eps)
+        self.self_attn = FusedLlamaAttention(dim, heads)
+        self.post_attention_layernorm = RMSNorm(dim, eps)
+        self.mlp = FusedLlamaMLP(dim, intermediate_dim)
+        self._register_state_dict_hook(LlamaBlock._split_state_dict)
+
+    def forward(self, x, position_embeddings, attention_mask=None, **attention_kwargs):
+        x = x + self.self_attn(self.input_layernorm(x), position_embeddings, attention_mask, **attention_kwargs)
+        x = x + self.mlp(self.post_attention_layernorm(x))
+        return x
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _fuse_weights(state_dict, prefix + "self_attn.", self.QKV, "qkv_proj")
+        _fuse_weights(state_dict, prefix + "mlp.", self.GATE_UP, "gate_up_proj")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @staticmethod
+    def _split_state_dict(module, state_dict, prefix, local_metadata):
+        # quantized projections keep their own layout
+        if type(module.self_attn.qkv_proj) is nn.Linear:
+            _split_weights(state_dict, prefix + "self_attn.", LlamaBlock.QKV, "qkv_proj")
+        if type(module.mlp.gate_up_proj) is nn.Linear:
+            _split_weights(state_dict, prefix + "mlp.", LlamaBlock.GATE_UP, "gate_up_proj")
+        return state_dict
+
+
 # attention mask realated
 
 
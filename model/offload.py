@@ -0,0 +1,145 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Weight offloading for hosts whose device cannot hold all models at once.
+
+        streamer = BlockStreamer(cfm.transformer, "cuda")  # dit blocks streamed in per forward
+        vae_offload = IdleOffload(vae, "cuda")              # vae on the device only while used
+        with vae_offload:
+            audio = decode_audio(latent, vae)
+"""
+
+from __future__ import annotations
+
+import contextlib
+import threading
+
+import torch
+from torch import nn
+
+from model.dit import DiT
+
+
+class BlockStreamer:
+    """
+    Keeps the weights of DiT.transformer_blocks on the host and copies every block to the device
+    just before it runs, dropping it again right after. The copy of the next block is issued on a
+    side cuda stream while the current one computes, so at most two blocks are resident on the
+    device. Everything else of the dit is moved to the device.
+    pin_memory - page locked host copies for asynchronous transfers, False keeps tensors mapped
+                 from an exported checkpoint in the page cache instead of in process memory
+    Not meant to be combined with compile_dit or int8-dynamic quantization.
+    """
+
+    def __init__(self, dit: DiT, device, pin_memory=True):
+        self.dit = dit
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        pin_memory = pin_memory and self.stream is not None
+
+        for name, child in dit.named_children():
+            if name != "transformer_blocks":
+                child.to(self.device)
+
+        self.blocks = list(dit.transformer_blocks)
+        self.host = []
+        for block in self.blocks:
+            tensors = list(block.parameters()) + list(block.buffers())
+            for tensor in tensors:
+                data = tensor.data.to("cpu")
+                tensor.data = data.pin_memory() if pin_memory else data
+            self.host.append([(tensor, tensor.data) for tensor in tensors])
+        self.events = [None] * len(self.blocks)
+        self.resident = set()
+
+        self.handles = []
+        for i, block in enumerate(self.blocks):
+            self.handles.append(block.register_forward_pre_hook(self._pre_hook(i)))
+            self.handles.append(block.register_forward_hook(self._post_hook(i)))
+
+    def _load(self, i):
+        if i in self.resident:
+            return
+        stream = torch.cuda.stream(self.stream) if self.stream is not None else contextlib.nullcontext()
+        with stream:
+            for tensor, data in self.host[i]:
+                tensor.data = data.to(self.device, non_blocking=True)
+            if self.stream is not None:
+                self.events[i] = self.stream.record_event()
+        self.resident.add(i)
+
+    def _wait(self, i):
+        if self.events[i] is None:
+            return
+        current = torch.cuda.current_stream(self.device)
+        current.wait_event(self.events[i])
+        # copied on the side stream but used and freed on the current one
+        for tensor, _ in self.host[i]:
+            tensor.data.record_stream(current)
+        self.events[i] = None
+
+    def _pre_hook(self, i):
+        def hook(module, args):
+            self._load(i)
+            self._wait(i)
+            # the block after the last one is the first block of the next ode step
+            self._load((i + 1) % len(self.blocks))
+        return hook
+
+    def _post_hook(self, i):
+        def hook(module, args, output):
+            for tensor, data in self.host[i]:
+                tensor.data = data
+            self.resident.discard(i)
+        return hook
+
+    def remove(self):
+        # back to plain device resident blocks
+        for handle in self.handles:
+            handle.remove()
+        for host in self.host:
+            for tensor, data in host:
+                tensor.data = data.to(self.device)
+        self.resident = set(range(len(self.blocks)))
+
+
+class IdleOffload:
+    """
+    Context manager that keeps a module (muq, vae) on offload_device and moves it to device only
+    while used. Nested and concurrent users share one move, it goes back once the last one leaves.
+    """
+
+    def __init__(self, module: nn.Module, device, offload_device="cpu"):
+        self.module = module
+        self.device = device
+        self.offload_device = offload_device
+        self.users = 0
+        self.lock = threading.Lock()
+        module.to(offload_device)
+
+    def __enter__(self):
+        with self.lock:
+            if self.users == 0:
+                self.module.to(self.device)
+            self.users += 1
+        return self.module
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.users -= 1
+            if self.users == 0:
+                self.module.to(self.offload_device)
+                if torch.cuda.is_available():
+                    torch.cuda.empty_cache()
+        return False
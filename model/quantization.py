@@ -0,0 +1,143 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import re
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+from model.dit import DiT
+
+
+QUANT_MODES = ("int8-dynamic", "int8-weight")
+
+# linears of the dit that are quantized, the small time / text conv-next layers stay in float
+QUANT_TARGETS = re.compile(
+    r"transformer_blocks\.\d+\.(self_attn\.(qkv|o)_proj|mlp\.(gate_up|down)_proj)"
+    r"|text_fusion_linears\.\d+\.0"
+    r"|input_embed\.proj"
+    r"|proj_out"
+)
+
+
+def quantizable_linears(dit: DiT):
+    return {
+        name: module
+        for name, module in dit.named_modules()
+        if isinstance(module, nn.Linear) and QUANT_TARGETS.fullmatch(name)
+    }
+
+
+class Int8Linear(nn.Module):
+    """
+    Linear with int8 weights and one float scale per output channel, dequantized on the fly.
+    Halves the weight memory of fp16 (quarter of fp32) on any device, compute stays in float.
+    """
+
+    def __init__(self, weight, scale, bias=None):
+        super().__init__()
+        self.in_features, self.out_features = weight.shape[1], weight.shape[0]
+        self.register_buffer("weight", weight)
+        self.register_buffer("scale", scale)
+        self.register_buffer("bias", bias)
+
+    @classmethod
+    def from_float(cls, linear: nn.Linear):
+        weight = linear.weight.detach()
+        scale = weight.abs().amax(dim=1).float().clamp(min=1e-8) / 127
+        qweight = torch.round(weight.float() / scale[:, None]).clamp(-127, 127).to(torch.int8)
+        bias = linear.bias.detach().clone() if linear.bias is not None else None
+        return cls(qweight, scale.to(weight.dtype), bias)
+
+    def forward(self, x):
+        weight = self.weight.to(x.dtype) * self.scale[:, None].to(x.dtype)
+        return F.linear(x, weight, self.bias)
+
+    def extra_repr(self):
+        return f"in_features={self.in_features}, out_features={self.out_features}"
+
+
+def _set_module(root, name, module):
+    parent, _, child = name.rpartition(".")
+    setattr(root.get_submodule(parent) if parent else root, child, module)
+
+
+def _quantize_linear(linear, mode):
+    if mode == "int8-weight":
+        return Int8Linear.from_float(linear)
+    # int8 weights and per call int8 activations, int8 gemm on cpu (fbgemm / onednn)
+    from torch.ao.quantization import per_channel_dynamic_qconfig, quantize_dynamic
+
+    if linear.weight.dtype != torch.float32:
+        raise ValueError("int8-dynamic quantization needs an fp32 model, load it with dtype=torch.float32")
+    wrapper = nn.Sequential(linear)
+    return quantize_dynamic(wrapper, {"0": per_channel_dynamic_qconfig}, dtype=torch.qint8)[0]
+
+
+def quantize_dit(dit: DiT, mode="int8-dynamic", skip=()):
+    """
+    Replaces the transformer block, text fusion, input and output projection linears in place.
+    int8-dynamic - int8 weights and dynamically quantized activations, cpu only, fp32 model
+    int8-weight  - int8 weights dequantized to the activation dtype, any device and dtype
+    skip         - names of linears kept in float, e.g. from calibrate_dit
+    """
+    if mode not in QUANT_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}. Supported modes are {QUANT_MODES}.")
+    for name, linear in quantizable_linears(dit).items():
+        if name not in skip:
+            _set_module(dit, name, _quantize_linear(linear, mode))
+    dit.clear_cache()
+    return dit
+
+
+@torch.no_grad()
+def calibrate_dit(dit: DiT, run, mode="int8-dynamic", max_rows=512):
+    """
+    Measures how much quantizing each target linear alone changes its output.
+    run - callable that runs the float model on representative inputs, e.g. a few sampling steps
+    Inputs of every linear are recorded (at most max_rows rows per call) and the relative l2
+    error of the quantized layer on them is returned as {name: error}.
+    """
+    linears = quantizable_linears(dit)
+    inputs = {name: [] for name in linears}
+
+    def hook(name):
+        def record(module, args, output):
+            x = args[0].reshape(-1, args[0].shape[-1])
+            if x.shape[0] > max_rows:
+                x = x[torch.randperm(x.shape[0], device=x.device)[:max_rows]]
+            inputs[name].append(x.to("cpu", torch.float32))
+        return record
+
+    handles = [linear.register_forward_hook(hook(name)) for name, linear in linears.items()]
+    try:
+        run()
+    finally:
+        for handle in handles:
+            handle.remove()
+
+    errors = {}
+    for name, linear in linears.items():
+        if not inputs[name]:
+            continue
+        x = torch.cat(inputs[name])
+        reference = nn.Linear(linear.in_features, linear.out_features, bias=linear.bias is not None)
+        reference.load_state_dict({k: v.to("cpu", torch.float32) for k, v in linear.state_dict().items()})
+        quantized = _quantize_linear(reference, mode)
+        y = reference(x)
+        errors[name] = ((quantized(x) - y).norm() / y.norm().clamp(min=1e-8)).item()
+    return errors
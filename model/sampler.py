@@ -0,0 +1,154 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import torch
+
+
+SOLVERS = ("euler", "midpoint", "heun", "dpm_multistep", "adaptive_heun")
+
+
+class GuidanceSchedule:
+    """
+    Decides on which solver calls classifier-free guidance runs the unconditional branch.
+
+    interval    - (t_min, t_max), guidance is applied only for t_min <= t <= t_max,
+                  outside of it only the conditional branch runs
+    reuse_steps - inside the interval, the unconditional prediction is recomputed once every
+                  reuse_steps + 1 calls and the last one is reused in between
+    """
+
+    def __init__(self, interval=(0.0, 1.0), reuse_steps=0):
+        self.t_min, self.t_max = interval
+        self.reuse_steps = reuse_steps
+
+    def in_interval(self, t: float):
+        return self.t_min <= t <= self.t_max
+
+    def recompute(self, guided_calls: int):
+        return guided_calls % (self.reuse_steps + 1) == 0
+
+
+class ODESampler:
+    """
+    Integrates the flow matching ode dx/dt = fn(t, x) from t[0] to t[-1].
+
+    method  - "euler", "midpoint", "heun": one step per interval of the time grid
+            - "dpm_multistep": second order multistep (dpm-solver++ 2m for the velocity ode),
+              reuses the previous prediction so costs one evaluation per interval
+            - "adaptive_heun": heun with embedded euler error estimate, only t[0] and t[-1]
+              of the grid are used, the initial step is the mean grid spacing
+    nfe     - number of fn evaluations of the last call
+    """
+
+    def __init__(
+        self,
+        method="euler",
+        atol=1e-2,
+        rtol=1e-2,
+        max_nfe=128,
+        record_trajectory=False,
+    ):
+        if method not in SOLVERS:
+            raise ValueError(f"Unknown solver: {method}. Supported solvers are {SOLVERS}.")
+        self.method = method
+        self.atol = atol
+        self.rtol = rtol
+        self.max_nfe = max_nfe
+        self.record_trajectory = record_trajectory
+
+        self.nfe = 0
+        self.trajectory = None
+
+    def _fn(self, fn, t, x):
+        self.nfe += 1
+        return fn(t, x)
+
+    def _record(self, x):
+        if self.record_trajectory:
+            self.trajectory.append(x.clone())
+
+    @torch.no_grad()
+    def __call__(self, fn, y0: float["b n d"], t: float["s"]):  # noqa: F722 F821
+        self.nfe = 0
+        self.trajectory = [] if self.record_trajectory else None
+
+        # state buffers are allocated once and updated in place
+        x = y0.clone()
+        x_tmp = torch.empty_like(x)
+        self._record(x)
+
+        if self.method == "adaptive_heun":
+            self._adaptive_heun(fn, x, x_tmp, t)
+        else:
+            step = getattr(self, f"_{self.method}")
+            dts = (t[1:] - t[:-1]).tolist()
+            prev = None
+            for i, dt in enumerate(dts):
+                prev = step(fn, x, x_tmp, t[i], dt, prev)
+                self._record(x)
+
+        if self.record_trajectory:
+            self.trajectory = torch.stack(self.trajectory)
+        return x
+
+    def _euler(self, fn, x, x_tmp, t, dt, prev):
+        x.add_(self._fn(fn, t, x), alpha=dt)
+
+    def _midpoint(self, fn, x, x_tmp, t, dt, prev):
+        torch.add(x, self._fn(fn, t, x), alpha=dt / 2, out=x_tmp)
+        x.add_(self._fn(fn, t + dt / 2, x_tmp), alpha=dt)
+
+    def _heun(self, fn, x, x_tmp, t, dt, prev):
+        k1 = self._fn(fn, t, x)
+        torch.add(x, k1, alpha=dt, out=x_tmp)
+        k2 = self._fn(fn, t + dt, x_tmp)
+        x.add_(k1, alpha=dt / 2).add_(k2, alpha=dt / 2)
+
+    def _dpm_multistep(self, fn, x, x_tmp, t, dt, prev):
+        v = self._fn(fn, t, x)
+        if prev is None:
+            x.add_(v, alpha=dt)
+        else:
+            prev_v, prev_dt = prev
+            # linear extrapolation of the velocity over the step, variable step size
+            r = dt / (2 * prev_dt)
+            x.add_(v, alpha=dt * (1 + r)).add_(prev_v, alpha=-dt * r)
+        return v, dt
+
+    def _adaptive_heun(self, fn, x, x_tmp, t):
+        # keep time on host in full precision, half precision time would stall near t_end
+        t_cur, t_end = t[0].item(), t[-1].item()
+        dt = (t_end - t_cur) / max(len(t) - 1, 1)
+        while t_end - t_cur > 1e-6:
+            # finish in one step when another rejected step would exceed the evaluation budget
+            out_of_budget = self.nfe + 4 > self.max_nfe
+            dt = t_end - t_cur if out_of_budget else min(dt, t_end - t_cur)
+            k1 = self._fn(fn, t.new_tensor(t_cur), x)
+            torch.add(x, k1, alpha=dt, out=x_tmp)
+            k2 = self._fn(fn, t.new_tensor(t_cur + dt), x_tmp)
+
+            # difference between heun and euler solutions
+            err = (k2 - k1).mul_(dt / 2)
+            scale = self.atol + self.rtol * torch.maximum(x.abs(), x_tmp.abs())
+            err_norm = err.div_(scale).pow_(2).mean().sqrt().item()
+
+            if err_norm <= 1.0 or out_of_budget:
+                x.add_(k1, alpha=dt / 2).add_(k2, alpha=dt / 2)
+                t_cur = t_cur + dt
+                self._record(x)
+
+            factor = 0.9 * err_norm ** -0.5 if err_norm > 0 else 5.0
+            dt = dt * min(max(factor, 0.2), 5.0)
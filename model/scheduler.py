@@ -0,0 +1,158 @@
+# Copyright (c) 2025 ASLP-LAB
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#     http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import annotations
+
+import torch
+import torch.nn.functional as F
+from torch.nn.utils.rnn import pad_sequence
+
+from model.cfm import CFM, custom_mask_from_start_end_indices
+from model.utils import exists
+
+
+class _Slot:
+    def __init__(self, request_id, request, x, t, cond, step_cond, fixed_span_mask, prepared, null_prepared, cfg_strength):
+        self.request_id = request_id
+        self.request = request
+        self.x = x  # n d, current ode state
+        self.t = t  # time grid of this request
+        self.dts = (t[1:] - t[:-1]).tolist()
+        self.step = 0
+        self.cond = cond
+        self.step_cond = step_cond
+        self.fixed_span_mask = fixed_span_mask
+        self.prepared = prepared
+        self.null_prepared = null_prepared
+        self.cfg_strength = cfg_strength
+
+    @property
+    def done(self):
+        return self.step >= len(self.dts)
+
+
+class ContinuousBatchScheduler:
+    """
+    Continuous batching at ode step granularity for euler sampling with classifier-free guidance.
+
+    DiT takes one time step per sample, so the running batch can hold requests at different
+    solver steps. New requests join at step 0 whenever a slot is free and finished ones leave
+    right away instead of waiting for the whole batch to drain. Requests use the dict layout
+    of CFM.sample_batch, optionally with their own steps and cfg_strength.
+
+        scheduler.add(request_id, request)
+        while scheduler.has_work():
+            for request_id, latent in scheduler.step():
+                ...
+    """
+
+    def __init__(self, cfm: CFM, max_batch_size=4, steps=32, cfg_strength=4.0):
+        self.cfm = cfm
+        self.max_batch_size = max_batch_size
+        self.steps = steps
+        self.cfg_strength = cfg_strength
+
+        self.waiting = []
+        self.active = []
+        self._batch_ids = None
+        self._batch_prepared = None
+        self._dtype = next(cfm.parameters()).dtype
+
+    def add(self, request_id, request: dict):
+        self.waiting.append((request_id, request))
+
+    def has_work(self):
+        return bool(self.waiting or self.active)
+
+    @torch.no_grad()
+    def _admit(self, request_id, request):
+        cfm, transformer = self.cfm, self.cfm.transformer
+        device, dtype = cfm.device, next(cfm.parameters()).dtype
+
+        duration = request["duration"]
+        cond = request["cond"][0, :duration].to(device, dtype)
+        cond = F.pad(cond, (0, 0, 0, duration - cond.shape[0]))
+        latent_pred_segments = torch.tensor(request["latent_pred_segments"]).to(device)
+        fixed_span_mask = custom_mask_from_start_end_indices(duration, latent_pred_segments, device=device, max_seq_len=duration)
+        fixed_span_mask = fixed_span_mask.reshape(duration, 1)
+        step_cond = torch.where(fixed_span_mask, torch.zeros_like(cond), cond)
+        text = request["text"][:, :duration].to(device)
+        text = F.pad(text, (0, duration - text.shape[1]))
+        start_time = request["start_time"].to(device, dtype)
+        song_duration = request["song_duration"].to(device, dtype)
+
+        # same noise as CFM.sample_batch with the same seed
+        if exists(request.get("seed")):
+            torch.manual_seed(request["seed"])
+        x = torch.randn(duration, cfm.num_channels, device=device, dtype=dtype).float()
+
+        t = torch.linspace(0, 1, request.get("steps", self.steps), device=device, dtype=torch.float32)
+
+        prepared = transformer.forward_timestep_invariant(text, duration, False, start_time, song_duration)
+        null_prepared = transformer.forward_timestep_invariant(text, duration, True, start_time, song_duration)
+
+        slot = _Slot(
+            request_id, request, x, t, cond, step_cond, fixed_span_mask, prepared, null_prepared,
+            request.get("cfg_strength", self.cfg_strength),
+        )
+        self.active.append(slot)
+
+    @torch.no_grad()
+    def step(self):
+        """Runs one solver step for every active request, returns [(request_id, [1 n d] latent)] of finished ones."""
+        self.cfm.eval()
+        while self.waiting and len(self.active) < self.max_batch_size:
+            self._admit(*self.waiting.pop(0))
+        if not self.active:
+            return []
+
+        slots = self.active
+        batch = len(slots)
+        device = slots[0].x.device
+
+        # conditioning only changes when requests join or leave
+        batch_ids = [slot.request_id for slot in slots]
+        if batch_ids != self._batch_ids:
+            self._batch_ids = batch_ids
+            self._batch_prepared = self.cfm.transformer.collate_prepared(
+                [slot.prepared for slot in slots] + [slot.null_prepared for slot in slots]
+            )
+
+        # cond and null branches of every request stacked along batch
+        x = pad_sequence([slot.x for slot in slots], padding_value=0, batch_first=True).to(self._dtype)
+        step_cond = pad_sequence([slot.step_cond for slot in slots], padding_value=0, batch_first=True)
+        style_prompt = torch.cat([slot.request["style_prompt"] for slot in slots], dim=0)
+        negative_style_prompt = torch.cat([slot.request["negative_style_prompt"] for slot in slots], dim=0)
+        time = torch.stack([slot.t[slot.step] for slot in slots]).to(self._dtype)
+        drop = torch.arange(2 * batch, device=device) >= batch
+
+        pred, null_pred = self.cfm.transformer(
+            x=torch.cat((x, x), dim=0), cond=torch.cat((step_cond, step_cond), dim=0), text=None,
+            time=torch.cat((time, time), dim=0), drop_audio_cond=drop, drop_text=drop, drop_prompt=False,
+            style_prompt=torch.cat((style_prompt, negative_style_prompt), dim=0).to(x.dtype),
+            prepared=self._batch_prepared,
+        ).chunk(2, dim=0)
+
+        finished = []
+        for i, slot in enumerate(slots):
+            n = slot.x.shape[0]
+            v = (pred[i, :n] + (pred[i, :n] - null_pred[i, :n]) * slot.cfg_strength).float()
+            slot.x.add_(v, alpha=slot.dts[slot.step])
+            slot.step += 1
+            if slot.done:
+                out = torch.where(slot.fixed_span_mask, slot.x, slot.cond)
+                finished.append((slot.request_id, out.unsqueeze(0)))
+
+        self.active = [slot for slot in slots if not slot.done]
+        return finished
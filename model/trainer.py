@@ -66,7 +66,8 @@ class Trainer:
         bnb_optimizer: bool = False,
         reset_lr: bool = False,
         use_style_prompt: bool = False,
-        grad_ckpt: bool = False
+        grad_ckpt: bool = False,
+        pretrained_ckpt_path: str | None = None,
     ):
         self.args = args
 
@@ -135,6 +136,9 @@ class Trainer:
         
         self.grad_ckpt = grad_ckpt
 
+        # released weights a new run is fine-tuned from, e.g. with local attention
+        self.pretrained_ckpt_path = pretrained_ckpt_path
+
         if bnb_optimizer:
             import bitsandbytes as bnb
 
@@ -202,12 +206,35 @@ class Trainer:
             else:
                 self.accelerator.save(checkpoint, f"{self.checkpoint_path}/model_{step}.pt")
 
+    def load_pretrained(self):
+        # model and ema start from the pretrained ema weights, optimizer and scheduler start fresh
+        checkpoint = torch.load(self.pretrained_ckpt_path, map_location="cpu", weights_only=True)
+        if "ema_model_state_dict" in checkpoint:
+            state_dict = {
+                k.replace("ema_model.", ""): v
+                for k, v in checkpoint["ema_model_state_dict"].items()
+                if k not in ["initted", "step"]
+            }
+        else:
+            state_dict = checkpoint.get("model_state_dict", checkpoint)
+
+        model = self.accelerator.unwrap_model(self.model)
+        model.load_state_dict(state_dict, strict=False)
+        if self.is_main:
+            self.ema_model.ema_model.load_state_dict(model.state_dict())
+
+        del checkpoint
+        gc.collect()
+        print("Pretrained weights loaded from", self.pretrained_ckpt_path)
+
     def load_checkpoint(self):
         if (
             not exists(self.checkpoint_path)
             or not os.path.exists(self.checkpoint_path)
             or not os.listdir(self.checkpoint_path)
         ):
+            if exists(self.pretrained_ckpt_path):
+                self.load_pretrained()
             return 0
 
         self.accelerator.wait_for_everyone()
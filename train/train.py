@@ -35,8 +35,16 @@ def main():
         wandb_resume_id = None
         model_cls = DiT
 
+    global_layers = [int(i) for i in str(args.global_layers).strip("'\"").split(",") if i.strip()]
+    global_blocks = [int(i) for i in str(args.global_blocks).strip("'\"").split(",") if i.strip()]
     model = CFM(
-        transformer=model_cls(**model_config["model"], max_frames=args.max_frames),
+        transformer=model_cls(
+            **model_config["model"],
+            max_frames=args.max_frames,
+            attention_window=args.attention_window or None,
+            global_layers=global_layers,
+            global_blocks=global_blocks,
+        ),
         num_channels=model_config["model"]['mel_dim'],
         audio_drop_prob=args.audio_drop_prob,
         cond_drop_prob=args.cond_drop_prob,
@@ -65,7 +73,8 @@ def main():
         bnb_optimizer=False,
         reset_lr=args.reset_lr,
         batch_size=args.batch_size,
-        grad_ckpt=args.grad_ckpt
+        grad_ckpt=args.grad_ckpt,
+        pretrained_ckpt_path=args.pretrained_ckpt_path or None,
     )
 
     trainer.train(